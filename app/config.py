@@ -1,5 +1,5 @@
 import warnings
-from typing import Self
+from typing import Literal, Self
 
 from pydantic import model_validator
 from pydantic_core import MultiHostUrl
@@ -25,6 +25,25 @@ class Settings(BaseSettings):
 
     LOG_LEVEL: str = 'DEBUG'
 
+    REFERENCE_CACHE_TTL: int = 300
+    REFERENCE_CONFIRM_TTL: int = 300
+    FLIGHT_RELATIONS_LOADING: Literal['joined', 'batched', 'cache'] = 'cache'
+    FAST_SERIALIZATION: bool = True
+    FLIGHT_RENDERING: Literal['python', 'database'] = 'python'
+    PARTITION_MONTHS_AHEAD: int = 3
+    ARCHIVE_DIR: str = 'archive'
+    FLIGHT_INGESTION: Literal['sync', 'queue'] = 'sync'
+    INGESTION_COALESCE_BATCHES: int = 50
+    INGESTION_POLL_INTERVAL: float = 1.0
+    INGESTION_MAX_RECORD_SIZE: int = 2 ** 20    # bytes of one ndjson line
+
+    RESPONSE_CACHE_BACKEND: Literal['memory', 'file', 'none'] = 'memory'
+    RESPONSE_CACHE_SIZE: int = 1024
+    RESPONSE_CACHE_DIR: str = '/tmp/svolog-response-cache'
+    RESPONSE_CACHE_TTL: int = 30
+    RESPONSE_CACHE_STALE_WHILE_REVALIDATE: int = 30
+    RESPONSE_CACHE_STALE_IF_ERROR: int = 600
+
     @property
     def DB_URI(self):
         return MultiHostUrl.build(
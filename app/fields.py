@@ -1,9 +1,10 @@
-from typing import Annotated
+from typing import Annotated, Optional
 from datetime import datetime, timezone
-from sqlalchemy import text
+from sqlalchemy import String, text
 from sqlalchemy.orm import mapped_column
 from functools import partial
 
 
 created_at = Annotated[datetime, mapped_column(server_default=text("now()"))]
 updated_at = Annotated[datetime, mapped_column(server_default=text("now()"), onupdate=partial(datetime.now, timezone.utc))]
+content_hash = Annotated[Optional[str], mapped_column(String(32))]     # digest of the last upserted record
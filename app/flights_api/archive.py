@@ -0,0 +1,157 @@
+import gzip
+import json
+import os
+import tempfile
+from collections import namedtuple
+from datetime import date, datetime, timezone
+from functools import lru_cache
+from typing import Iterable, Sequence
+
+import orjson
+from sqlalchemy import DateTime, Enum, Table
+
+from . import models
+from .partitions import add_months
+
+
+Month = namedtuple('Month', field_names=['flights', 'by_id', 'changelog'])
+
+
+def _columns(table: Table, rows: Sequence[dict]) -> dict[str, list]:
+    return {column.name: [row[column.name] for row in rows] for column in table.columns}
+
+
+def _rows(table: Table, columns: dict[str, list]) -> list[dict]:
+    decoded = {}
+    size = len(next(iter(columns.values()), ()))
+    for column in table.columns:
+        values = columns.get(column.name, [None] * size)    # added after the file was written
+        if isinstance(column.type, DateTime):
+            values = [datetime.fromisoformat(value) if value is not None else None for value in values]
+        elif isinstance(column.type, Enum) and column.type.enum_class is not None:
+            values = [column.type.enum_class(value) if value is not None else None for value in values]
+        decoded[column.name] = values
+    return [dict(zip(decoded, values)) for values in zip(*decoded.values())]
+
+
+@lru_cache(maxsize=8)
+def _read(path: str, _mtime: float) -> Month:
+    """ Decoded month, cached until the file changes."""
+    with gzip.open(path, 'rb') as f:
+        data = orjson.loads(f.read())
+
+    flights = tuple(_rows(models.FlightModel.__table__, data['flights']))
+    changelog = {}
+    for row in _rows(models.FlightsChangelogModel.__table__, data['changelog']):
+        changelog.setdefault(row['flight_id'], []).append(row)
+    return Month(flights=flights, by_id={flight['id']: flight for flight in flights}, changelog=changelog)
+
+
+@lru_cache(maxsize=8)
+def _index(path: str, _mtime: float) -> dict[date, dict]:
+    """ Parsed index.json, cached until the file changes."""
+    with open(path) as f:
+        return {date.fromisoformat(month): entry for month, entry in json.load(f).items()}
+
+
+class FlightArchive:
+    """ Flights of past sked_local months with their changelog, moved out of the database by scripts.archive_flights.
+    One gzip compressed file per month holds every column as an array, index.json keeps the id range of every month.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _file(self, month: date) -> str:
+        return os.path.join(self.path, f'flights-{month:%Y-%m}.json.gz')
+
+    def index(self) -> dict[date, dict]:
+        path = os.path.join(self.path, 'index.json')
+        try:
+            return dict(_index(path, os.path.getmtime(path)))     # a copy, write() adds to it
+        except FileNotFoundError:
+            return {}
+
+    def hot_since(self) -> datetime | None:
+        """ Start of the first month after the archived ones, None without an archive."""
+        if not (index := self.index()):
+            return None
+        month = add_months(max(index), 1)
+        return datetime(month.year, month.month, 1, tzinfo=timezone.utc)
+
+    def covers(self, date_start: datetime | None) -> bool:
+        return date_start is not None and (hot_since := self.hot_since()) is not None and date_start < hot_since
+
+    def read(self, month: date) -> Month:
+        path = self._file(month)
+        return _read(path, os.path.getmtime(path))
+
+    def flights(self, date_start: datetime, date_end: datetime) -> list[dict]:
+        """ Rows of the archived flights sked within [date_start, date_end]."""
+        months = [
+            month for month in self.index()
+            if month <= date_end.astimezone(timezone.utc).date() and add_months(month, 1) > date_start.astimezone(timezone.utc).date()
+        ]
+        return [
+            flight
+            for month in sorted(months)
+            for flight in self.read(month).flights
+            if flight['sked_local'] is not None and date_start <= flight['sked_local'] <= date_end
+        ]
+
+    def get_many(self, ids: Iterable[int], changelog: bool = False) -> dict[int, models.FlightModel]:
+        found = {}
+        for month, entry in self.index().items():
+            if wanted := [id for id in ids if entry['min_id'] <= id <= entry['max_id']]:
+                stored = self.read(month)
+                found.update({id: self.model(stored.by_id[id], stored if changelog else None) for id in wanted if id in stored.by_id})
+        return found
+
+    def get(self, id: int, changelog: bool = False) -> models.FlightModel | None:
+        return self.get_many([id], changelog=changelog).get(id)
+
+    @staticmethod
+    def model(row: dict, month: Month | None = None) -> models.FlightModel:
+        """ Transient model of an archived row, with the changelog when its month is given."""
+        entries = month.changelog.get(row['id'], ()) if month is not None else ()
+        return models.FlightModel(
+            **row,
+            changelog=[models.FlightsChangelogModel(**entry) for entry in sorted(entries, key=lambda entry: entry['created_at'], reverse=True)],
+        )
+
+    def write(self, month: date, flights: Sequence[dict], changelog: Sequence[dict]) -> None:
+        """ Adds rows of flights and changelog to the month file, flights already there are replaced."""
+        os.makedirs(self.path, exist_ok=True)
+        flights_table, changelog_table = models.FlightModel.__table__, models.FlightsChangelogModel.__table__
+        if os.path.exists(self._file(month)):
+            stored = self.read(month)
+            ids = {flight['id'] for flight in flights}
+            flights = [*(flight for flight in stored.flights if flight['id'] not in ids), *flights]
+            changelog = [*(entry for id, entries in stored.changelog.items() if id not in ids for entry in entries), *changelog]
+
+        data = orjson.dumps(
+            dict(flights=_columns(flights_table, flights), changelog=_columns(changelog_table, changelog)),
+            option=orjson.OPT_UTC_Z,
+        )
+        self._write(self._file(month), gzip.compress(data))
+
+        index = self.index()
+        index[month] = dict(
+            min_id=min(flight['id'] for flight in flights),
+            max_id=max(flight['id'] for flight in flights),
+            count=len(flights),
+            last_modified=max(flight['updated_at'] for flight in flights).isoformat(),
+        )
+        self._write(
+            os.path.join(self.path, 'index.json'),
+            json.dumps({month.isoformat(): entry for month, entry in sorted(index.items())}, indent=2).encode(),
+        )
+
+    def _write(self, path: str, data: bytes) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)      # readers never see a partial file
+
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Any, Collection, Type
+
+from pydantic import BaseModel
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import models, schemas
+from ..config import settings
+from ..database import async_session
+
+
+class ReferenceCache:
+    """ Versioned in-process copy of the reference tables as response schemas keyed by primary key.
+    Reloaded as a whole after a local commit touched a reference model or once ttl seconds passed,
+    other workers' changes are picked up by the ttl, by a reload on a missed key or by catch_up from a validator.
+    """
+    entities: dict[Type[models.Base], Type[BaseModel]] = {
+        models.AircraftModel: schemas.AircraftResponseSchema,
+        models.CountryModel: schemas.CountryResponseSchema,
+        models.CityModel: schemas.CityResponseSchema,
+        models.AirportModel: schemas.AirportResponseSchema,
+        models.CompanyModel: schemas.CompanyResponseSchema,
+    }
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.version = 0
+        self.last_modified: datetime | None = None     # latest updated_at of the loaded rows
+        self._data: dict[Type[models.Base], dict[Any, BaseModel]] = {model: {} for model in self.entities}
+        self._loaded_at: float | None = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    async def load(self) -> None:
+        data, modified = {}, []
+        async with async_session() as session:
+            for model, schema in self.entities.items():
+                pk = inspect(model).primary_key[0].name
+                rows = (await session.execute(select(model))).unique().scalars().all()
+                data[model] = {getattr(row, pk): schema.model_validate(row, from_attributes=True) for row in rows}
+                modified.extend(row.updated_at for row in rows)
+
+        self._data = data
+        self.last_modified = max(modified, default=None)
+        self._loaded_at = time.monotonic()
+        self.version += 1
+
+    async def refresh(self, force: bool = False) -> None:
+        if not (force or self.stale):
+            return
+
+        version = self.version
+        async with self._lock:
+            if self.version == version:     # not reloaded while waiting for the lock
+                await self.load()
+
+    def invalidate(self) -> None:
+        self._loaded_at = None
+
+    async def catch_up(self, last_modified: datetime | None) -> None:
+        """ Reloads when the database holds reference rows changed after the loaded ones, as by another worker."""
+        if last_modified is not None and (self.last_modified is None or last_modified > self.last_modified):
+            await self.refresh(force=True)
+
+    async def get(self, model: Type[models.Base], key: Any) -> BaseModel | None:
+        await self.refresh()
+        return self._data[model].get(key)
+
+    async def get_many(self, model: Type[models.Base], keys: Collection) -> dict[Any, BaseModel]:
+        """ Mapping of cached entities, reloaded once if any of the keys is missing."""
+        await self.refresh()
+        if any(key not in self._data[model] for key in keys if key is not None):
+            await self.refresh(force=True)
+        return self._data[model]
+
+
+class ConfirmedReferences:
+    """ Reference entities a committed upsert of this worker wrote or found unchanged, by model and primary key.
+    An entity equal to the confirmed one is skipped for ttl seconds, a local commit changing a row forgets it
+    and changes of cities or countries forget every airport. Other workers' changes are picked up by the ttl.
+    """
+    # model -> models whose entities embed it
+    dependants: dict[Type[models.Base], tuple[Type[models.Base], ...]] = {
+        models.CityModel: (models.AirportModel,),
+        models.CountryModel: (models.AirportModel,),
+    }
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._confirmed: dict[tuple[Type[models.Base], Any], tuple[BaseModel, float]] = {}
+
+    def unconfirmed(self, model: Type[models.Base], key: str, entities: Collection[BaseModel]) -> list[BaseModel]:
+        now = time.monotonic()
+        return [
+            entity for entity in entities
+            if (confirmed := self._confirmed.get((model, getattr(entity, key)))) is None
+            or confirmed[0] != entity or now - confirmed[1] > self.ttl
+        ]
+
+    def confirm_on_commit(self, session: AsyncSession, model: Type[models.Base], key: str, entities: Collection[BaseModel]) -> None:
+        session.sync_session.info.setdefault('confirmed_references', []).extend((model, getattr(entity, key), entity) for entity in entities)
+
+    def confirm(self, entries: Collection[tuple[Type[models.Base], Any, BaseModel]]) -> None:
+        now = time.monotonic()
+        self._confirmed.update({(model, pk): (entity, now) for model, pk, entity in entries})
+
+    def forget(self, identities: Collection[tuple[Type[models.Base], Any]]) -> None:
+        for model, pk in identities:
+            self._confirmed.pop((model, pk), None)
+        if dependants := {dependant for model, _ in identities for dependant in self.dependants.get(model, ())}:
+            self._confirmed = {identity: entry for identity, entry in self._confirmed.items() if identity[0] not in dependants}
+
+    def clear(self) -> None:
+        self._confirmed.clear()
+
+
+references = ReferenceCache(ttl=settings.REFERENCE_CACHE_TTL)
+confirmed = ConfirmedReferences(ttl=settings.REFERENCE_CONFIRM_TTL)
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_references(session: Session, _flush_context):
+    changed = [obj for obj in (*session.new, *session.dirty, *session.deleted) if isinstance(obj, tuple(ReferenceCache.entities))]
+    if changed:
+        session.info['references_changed'] = True
+        session.info.setdefault('changed_references', set()).update(
+            (type(obj), *inspect(obj).mapper.primary_key_from_instance(obj)) for obj in changed
+        )
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_references(session: Session):
+    if session.info.pop('references_changed', False):
+        references.invalidate()
+    confirmed.forget(session.info.pop('changed_references', ()))
+    confirmed.confirm(session.info.pop('confirmed_references', ()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_references(session: Session):
+    for name in ('references_changed', 'changed_references', 'confirmed_references'):
+        session.info.pop(name, None)
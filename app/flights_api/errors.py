@@ -1,4 +1,6 @@
 from fastapi import HTTPException, status
 
 
-NOT_FOUND = HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Not Found')
\ No newline at end of file
+NOT_FOUND = HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Not Found')
+INVALID_CURSOR = HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+INVALID_BODY = HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid request body encoding')
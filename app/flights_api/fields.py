@@ -4,3 +4,15 @@ from enum import StrEnum
 class Direction(StrEnum):
     arrival = 'arrival'
     departure = 'departure'
+
+
+class CountMode(StrEnum):
+    exact = 'exact'
+    estimate = 'estimate'
+    none = 'none'
+
+
+class BatchStatus(StrEnum):
+    pending = 'pending'
+    applied = 'applied'
+    failed = 'failed'
@@ -0,0 +1,133 @@
+""" Queued flights ingestion, PUT /flights/ with FLIGHT_INGESTION=queue.
+
+Validated batches are stored in flight_batches and the request returns right away.
+A consumer in every worker locks the pending batches with SKIP LOCKED, keeps the latest record of every orig_id
+over them in queue order and upserts those in one transaction. Consumers take turns on an advisory lock,
+batches of two of them could share an orig_id and the older one could commit last.
+"""
+import asyncio
+from collections import Counter
+from typing import Collection
+
+from pydantic import TypeAdapter
+from sqlalchemy import event, insert, select, text, update
+from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import models, schemas, services
+from .fields import BatchStatus
+from ..config import settings
+from ..database import async_session
+from ..logger import main_logger
+from ..response_cache import response_cache
+
+
+# FlightSchema keeps the nested entities, FlightDBSchema would dump their keys only
+_payload = TypeAdapter(list[schemas.FlightSchema])
+_queued = asyncio.Event()
+
+
+async def enqueue(session: AsyncSession, flights: Collection[schemas.FlightDBSchema]) -> schemas.FlightBatchSchema:
+    query = (
+        insert(models.FlightBatchModel)
+        .values(flights=_payload.dump_python(list(flights), mode='json'), received=len(flights))
+        .returning(models.FlightBatchModel)
+    )
+    batch = (await session.execute(query)).scalar_one()
+    session.sync_session.info['flights_queued'] = True
+    return schemas.FlightBatchSchema.model_validate(batch)
+
+
+async def get(session: AsyncSession, id: int) -> schemas.FlightBatchSchema | None:
+    batch = await session.get(models.FlightBatchModel, id)
+    return schemas.FlightBatchSchema.model_validate(batch) if batch is not None else None
+
+
+def coalesce(batches: Collection[models.FlightBatchModel]) -> tuple[dict[int, dict], dict[int, int]]:
+    """ Latest record of every orig_id over the batches in queue order, with the id of the batch it came from."""
+    latest, source = {}, {}
+    for batch in sorted(batches, key=lambda batch: batch.id):
+        for flight in batch.flights:
+            latest[flight['orig_id']] = flight
+            source[flight['orig_id']] = batch.id
+    return latest, source
+
+
+async def apply_pending(limit: int | None = None) -> int:
+    """ Applies up to limit pending batches in one transaction, returns the number of batches taken."""
+    return await _apply(limit or settings.INGESTION_COALESCE_BATCHES)
+
+
+async def _apply(limit: int, id: int | None = None) -> int:
+    model = models.FlightBatchModel
+    query = select(model).filter(model.status == BatchStatus.pending).order_by(model.id).limit(limit).with_for_update(skip_locked=True)
+    if id is not None:
+        query = query.filter(model.id == id)
+
+    ids = []
+    try:
+        async with async_session() as session, session.begin():
+            await session.execute(text('SELECT pg_advisory_xact_lock(hashtext(:name))'), dict(name=model.__tablename__))
+            batches = (await session.execute(query)).scalars().all()
+            ids = [batch.id for batch in batches]
+            if not batches:
+                return 0
+
+            latest, source = coalesce(batches)
+            response_cache.invalidate_on_commit(session, *response_cache.namespaces)
+            changelog = await services.FlightService.upsert_many(
+                session,
+                [schemas.FlightDBSchema.model_validate(flight) for flight in latest.values()],
+            )
+
+            upserted = Counter(source.values())
+            changed = Counter(source[change.model.orig_id] for change in changelog)
+            for batch in batches:
+                batch.status = BatchStatus.applied
+                batch.upserted = upserted[batch.id]
+                batch.superseded = batch.received - upserted[batch.id]
+                batch.changed = changed[batch.id]
+                batch.flights = None
+    except (OperationalError, InterfaceError):
+        # deadlock or lost connection, the batches stay pending for the next round
+        raise
+    except Exception as exc:
+        if not ids:
+            raise
+        if len(ids) > 1:
+            # one invalid batch must not hold back the others
+            for id in ids:
+                await _apply(limit=1, id=id)
+        else:
+            main_logger.error(f'Flight batch {ids[0]} failed', exc_info=True)
+            async with async_session() as session, session.begin():
+                await session.execute(update(model).filter(model.id == ids[0]).values(status=BatchStatus.failed, error=str(exc)))
+
+    return len(ids)
+
+
+async def consumer_loop(interval: float | None = None) -> None:
+    while True:
+        _queued.clear()
+        try:
+            if await apply_pending():
+                continue
+        except Exception:
+            main_logger.error('Flight batches consumer failed', exc_info=True)
+
+        try:
+            await asyncio.wait_for(_queued.wait(), timeout=interval or settings.INGESTION_POLL_INTERVAL)
+        except TimeoutError:
+            pass
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_consumer(session: Session):
+    if session.info.pop('flights_queued', False):
+        _queued.set()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_queued(session: Session):
+    session.info.pop('flights_queued', None)
@@ -1,20 +1,30 @@
-from datetime import datetime
+from datetime import date, datetime
 from typing import Optional
 
-from sqlalchemy import ForeignKey, String, DECIMAL
+from sqlalchemy import DDL, ForeignKey, String, DECIMAL, Index, event, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
+from . import partitions
 from ..models import Base
-from .fields import Direction
-from ..fields import created_at, updated_at
+from .fields import BatchStatus, Direction
+from ..fields import content_hash, created_at, updated_at
+
+
+def trgm_index(table: str, column: str) -> Index:
+    return Index(f'ix_{table}_{column}_trgm', column, postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'})
 
 
 class AircraftModel(Base):
     __tablename__ = 'aircrafts'
+    __table_args__ = (
+        trgm_index('aircrafts', 'name'),
+    )
 
     name: Mapped[str] = mapped_column(primary_key=True)
     orig_id: Mapped[Optional[int]] = mapped_column()
 
+    content_hash: Mapped[content_hash]
     created_at: Mapped[created_at]
     updated_at: Mapped[updated_at]
 
@@ -23,10 +33,15 @@ class AircraftModel(Base):
 
 class CountryModel(Base):
     __tablename__ = 'countries'
+    __table_args__ = (
+        trgm_index('countries', 'name'),
+        trgm_index('countries', 'region'),
+    )
 
     name: Mapped[str] = mapped_column(primary_key=True)
     region: Mapped[Optional[str]] = None
 
+    content_hash: Mapped[content_hash]
     created_at: Mapped[created_at]
     updated_at: Mapped[updated_at]
 
@@ -35,12 +50,18 @@ class CountryModel(Base):
 
 class CityModel(Base):
     __tablename__ = 'cities'
+    __table_args__ = (
+        trgm_index('cities', 'name'),
+        trgm_index('cities', 'name_ru'),
+        trgm_index('cities', 'timezone'),
+    )
 
     name: Mapped[str] = mapped_column(primary_key=True)
     name_ru: Mapped[str]
     timezone: Mapped[str]
-    country_name: Mapped[str] = mapped_column(ForeignKey('countries.name', ondelete='set null'))
+    country_name: Mapped[str] = mapped_column(ForeignKey('countries.name', ondelete='set null'), index=True)
 
+    content_hash: Mapped[content_hash]
     created_at: Mapped[created_at]
     updated_at: Mapped[updated_at]
 
@@ -50,6 +71,10 @@ class CityModel(Base):
 
 class AirportModel(Base):
     __tablename__ = 'airports'
+    __table_args__ = (
+        trgm_index('airports', 'name'),
+        trgm_index('airports', 'name_ru'),
+    )
 
     iata: Mapped[str] = mapped_column(String(3), primary_key=True)
     icao: Mapped[Optional[str]] = mapped_column(String(4))
@@ -59,8 +84,9 @@ class AirportModel(Base):
     name_ru: Mapped[str]
     lat: Mapped[Optional[float]] = mapped_column(DECIMAL(9, 6))
     long: Mapped[Optional[float]] = mapped_column(DECIMAL(9, 6))
-    city_name: Mapped[str] = mapped_column(ForeignKey('cities.name', ondelete='set null'))
+    city_name: Mapped[str] = mapped_column(ForeignKey('cities.name', ondelete='set null'), index=True)
 
+    content_hash: Mapped[content_hash]
     created_at: Mapped[created_at]
     updated_at: Mapped[updated_at]
 
@@ -69,12 +95,16 @@ class AirportModel(Base):
 
 class CompanyModel(Base):
     __tablename__ = 'companies'
+    __table_args__ = (
+        trgm_index('companies', 'name'),
+    )
 
     iata: Mapped[str] = mapped_column(String(2), primary_key=True)
     name: Mapped[Optional[str]]
     url_buy: Mapped[Optional[str]]
     url_register: Mapped[Optional[str]]
 
+    content_hash: Mapped[content_hash]
     created_at: Mapped[created_at]
     updated_at: Mapped[updated_at]
 
@@ -83,6 +113,15 @@ class CompanyModel(Base):
 
 class FlightModel(Base):
     __tablename__ = 'flights'
+    __table_args__ = (
+        Index('ix_flights_sked_local_id', 'sked_local', 'id'),
+        Index('ix_flights_company_iata_sked_local', 'company_iata', 'sked_local'),
+        Index('ix_flights_mar1_iata_sked_local', 'mar1_iata', 'sked_local'),
+        Index('ix_flights_mar2_iata_sked_local', 'mar2_iata', 'sked_local'),
+        Index('ix_flights_direction_sked_local', 'direction', 'sked_local'),
+        Index('ix_flights_gate_id_sked_local', 'gate_id', 'sked_local'),
+        Index('ix_flights_number_sked_local', 'number', 'sked_local'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     orig_id: Mapped[int] = mapped_column(unique=True)
@@ -136,6 +175,7 @@ class FlightModel(Base):
     status_id: Mapped[Optional[int]]
     status_code: Mapped[Optional[int]]
 
+    content_hash: Mapped[content_hash]
     created_at: Mapped[created_at]
     updated_at: Mapped[updated_at]
 
@@ -149,14 +189,55 @@ class FlightModel(Base):
     changelog: Mapped[list['FlightsChangelogModel'] | None] = relationship(back_populates='flight', order_by='desc(FlightsChangelogModel.created_at)', lazy='noload')
 
 
+class FlightStatsModel(Base):
+    __tablename__ = 'flight_stats'
+    __table_args__ = (
+        # airport_iata is null for flights without mar1 and mar2, still one row per key
+        Index('ix_flight_stats_key', 'day', 'airport_iata', 'company_iata', 'direction', unique=True, postgresql_nulls_not_distinct=True),
+        Index('ix_flight_stats_airport_iata_day', 'airport_iata', 'day'),
+        Index('ix_flight_stats_company_iata_day', 'company_iata', 'day'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    day: Mapped[date]   # of sked_local in UTC
+    airport_iata: Mapped[Optional[str]] = mapped_column(String(3))     # mar1_iata or mar2_iata
+    company_iata: Mapped[str] = mapped_column(String(2))
+    direction: Mapped[Direction]
+    flight_count: Mapped[int]
+
+
 class FlightsChangelogModel(Base):
     __tablename__ = 'flights_changelog'
+    __table_args__ = partitions.monthly('created_at')
 
-    id: Mapped[int] = mapped_column(primary_key=True)
+    # a primary key of a partitioned table includes the partition key
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     flight_id: Mapped[int] = mapped_column(ForeignKey('flights.id', ondelete='set null'), index=True)
     field: Mapped[str]
     old_value: Mapped[Optional[str]]
 
-    created_at: Mapped[created_at]
+    created_at: Mapped[datetime] = mapped_column(primary_key=True, server_default=text("now()"))
 
     flight: Mapped['FlightModel'] = relationship(back_populates='changelog', lazy='noload')
+
+
+class FlightBatchModel(Base):
+    __tablename__ = 'flight_batches'
+    __table_args__ = (
+        Index('ix_flight_batches_pending', 'id', postgresql_where=text("status = 'pending'")),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    status: Mapped[BatchStatus] = mapped_column(default=BatchStatus.pending)
+    flights: Mapped[Optional[list]] = mapped_column(JSONB)     # dropped once applied
+    received: Mapped[int]
+    upserted: Mapped[Optional[int]]
+    superseded: Mapped[Optional[int]]
+    changed: Mapped[Optional[int]]
+    error: Mapped[Optional[str]]
+
+    created_at: Mapped[created_at]
+    updated_at: Mapped[updated_at]
+
+
+event.listen(Base.metadata, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
@@ -0,0 +1,117 @@
+""" Monthly range partitioning of tables declared with `__table_args__ = partitions.monthly(column)`.
+
+Every such table gets a DEFAULT partition and one partition per month, named `<table>_yYYYYmMM`,
+created up to PARTITION_MONTHS_AHEAD months after the current one on table creation, on startup and daily.
+"""
+import asyncio
+import re
+from datetime import date, datetime, timezone
+
+from sqlalchemy import Connection, Table, event, text
+
+from ..config import settings
+from ..database import async_engine
+from ..logger import main_logger
+from ..models import Base
+
+
+def monthly(column: str) -> dict:
+    """ Table args of a table range partitioned by the month of column."""
+    return dict(postgresql_partition_by=f'RANGE ({column})', info=dict(partition_by_month=column))
+
+
+def partitioned_tables() -> list[Table]:
+    return [table for table in Base.metadata.sorted_tables if 'partition_by_month' in table.info]
+
+
+def partition_name(table: Table, month: date) -> str:
+    return f'{table.name}_y{month.year}m{month.month:02}'
+
+
+def month_of(name: str) -> date | None:
+    if (match := re.search(r'_y(\d{4})m(\d{2})$', name)) is not None:
+        return date(int(match[1]), int(match[2]), 1)
+    return None
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _bound(month: date) -> str:
+    return datetime(month.year, month.month, 1, tzinfo=timezone.utc).isoformat()
+
+
+def attached(connection: Connection, table: Table) -> dict[str, date | None]:
+    """ Attached partitions by name with their month, None for the default one."""
+    rows = connection.execute(
+        text('SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = CAST(:table AS regclass)'),
+        dict(table=table.name),
+    )
+    return {name: month_of(name) for name, in rows}
+
+
+def create_partitions(connection: Connection, table: Table, since: date | None = None, ahead: int | None = None) -> list[str]:
+    """ Creates the default partition and the missing monthly ones from since up to ahead months from now.
+    A month whose rows already landed in the default partition stays there, attaching it would fail.
+    """
+    column = table.info['partition_by_month']
+    ahead = settings.PARTITION_MONTHS_AHEAD if ahead is None else ahead
+    # concurrent workers would race on the catalog
+    connection.execute(text('SELECT pg_advisory_xact_lock(hashtext(:table))'), dict(table=table.name))
+    connection.execute(text(f'CREATE TABLE IF NOT EXISTS {table.name}_default PARTITION OF {table.name} DEFAULT'))
+
+    existing = attached(connection, table)
+    current = datetime.now(timezone.utc).date().replace(day=1)
+    month = min((since or current).replace(day=1), current)
+    created = []
+    while month <= add_months(current, ahead):
+        name, end = partition_name(table, month), add_months(month, 1)
+        if name not in existing:
+            in_default = connection.execute(
+                text(f'SELECT EXISTS (SELECT FROM {table.name}_default WHERE {column} >= :start AND {column} < :end)'),
+                dict(start=_bound(month), end=_bound(end)),
+            ).scalar_one()
+            if in_default:
+                main_logger.warning(f'{name} not created, its rows are in {table.name}_default')
+            else:
+                connection.execute(text(
+                    f"CREATE TABLE {name} PARTITION OF {table.name} FOR VALUES FROM ('{_bound(month)}') TO ('{_bound(end)}')"
+                ))
+                created.append(name)
+        month = end
+    return created
+
+
+def detach_partitions(connection: Connection, table: Table, before: date) -> list[str]:
+    """ Detaches the monthly partitions of the months before the given one, they are left as plain tables."""
+    detached = []
+    for name, month in sorted(attached(connection, table).items(), key=lambda item: item[1] or date.max):
+        if month is not None and month < before.replace(day=1):
+            connection.execute(text(f'ALTER TABLE {table.name} DETACH PARTITION {name}'))
+            detached.append(name)
+    return detached
+
+
+def maintain(connection: Connection) -> None:
+    """ Keeps the future partitions of every partitioned table in place."""
+    for table in partitioned_tables():
+        if created := create_partitions(connection, table):
+            main_logger.info(f'Created partitions {", ".join(created)}')
+
+
+async def maintenance_loop(interval: float = 24 * 60 * 60) -> None:
+    while True:
+        try:
+            async with async_engine.begin() as conn:
+                await conn.run_sync(maintain)
+        except Exception:
+            main_logger.error('Partition maintenance failed', exc_info=True)
+        await asyncio.sleep(interval)
+
+
+@event.listens_for(Table, 'after_create')
+def _create_partitions(table: Table, connection: Connection, **_kw):
+    if 'partition_by_month' in table.info:
+        create_partitions(connection, table)
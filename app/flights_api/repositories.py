@@ -1,30 +1,138 @@
 import operator
-from collections import namedtuple
-from functools import cached_property
-from typing import Sequence, Iterable, Any, Literal, Type, TypeVar
+from enum import Enum
+from collections import Counter, namedtuple
+from datetime import date, datetime, timedelta, timezone
+from functools import cached_property, lru_cache
+from typing import AsyncIterator, Callable, Collection, Mapping, Sequence, Iterable, Any, Literal, Type, TypeVar
 
 import regex
-from sqlalchemy import select, inspect, and_, or_
+from pydantic import BaseModel
+from sqlalchemy import select, insert, delete, inspect, and_, or_, tuple_, func, null, literal, case, union, union_all, cast, extract, Date, Float, Integer, Text
+from sqlalchemy.dialects.postgresql import array as pg_array, insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload, noload
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import joinedload, load_only, noload
+from sqlalchemy.sql.expression import ClauseElement, ColumnElement, Executable
 
 from . import (
+    errors,
     models,
     patterns,
     utils,
 )
+from .archive import FlightArchive
+from .fields import CountMode, Direction
+from .partitions import add_months
+from ..config import settings
 
 
 Change = namedtuple('Change', field_names=['model', 'old_val', 'field'])
+Validator = namedtuple('Validator', field_names=['count', 'last_modified', 'references_modified'], defaults=[None])
+
+
+class FilterPlan(namedtuple('FilterPlan', field_names=['relations', 'clauses', 'columns', 'compare', 'operation'])):
+    """ Query alias resolved to models, columns and a comparison, values are bound per request."""
+    __slots__ = ()
+    python_operations = dict(in_=lambda value, values: value in values)
+
+    def bind(self, value):
+        return or_(*(self.compare(column, value) for column in self.columns))
+
+    def test(self, get: Callable[[Any], Any], value) -> bool:
+        """ bind evaluated in python over the column values returned by get, NULL matches nothing as in SQL."""
+        compare = self.python_operations.get(self.operation) or getattr(operator, self.operation, None)
+        if compare is None:
+            raise ValueError(f'{self.operation} has no python counterpart')
+        return any(compare(current, value) for column in self.columns if (current := get(column)) is not None)
+
+
+def _method_compare(name: str):
+    return lambda column, value: getattr(column, name)(value)
+
+
+@lru_cache(maxsize=None)
+def compile_filter(model: Type[models.Base], alias: str) -> FilterPlan:
+    match = regex.fullmatch(patterns.relation_alias, alias)
+    if match is None:
+        raise ValueError(f'{alias=} does not match pattern="{patterns.relation_alias}"')
+    match = match.capturesdict()
+
+    relations = []
+    for rel in match['relations']:
+        relation = getattr(models, rel, None)
+        if not (isinstance(relation, type) and issubclass(relation, models.Base)):
+            raise ValueError(f'{alias=}: unknown model {rel}')
+        relations.append(relation)
+    relation_model = relations[-1] if relations else model
+
+    for name in (*match['fields'], *match['clauses']):
+        if not hasattr(relation_model, name):
+            raise ValueError(f'{alias=}: {relation_model.__name__} has no field {name}')
+    columns = tuple(getattr(relation_model, field) for field in match['fields'])
+    clauses = tuple(getattr(relation_model, clause) for clause in match['clauses'])
+
+    if match['meth']:
+        if not all(hasattr(column, match['meth'][0]) for column in columns):
+            raise ValueError(f'{alias=}: unknown method {match["meth"][0]}')
+        compare = _method_compare(match['meth'][0])
+    elif match['op']:
+        compare = getattr(operator, match['op'][0], None)
+        if compare is None:
+            raise ValueError(f'{alias=}: unknown operator {match["op"][0]}')
+    else:
+        compare = operator.eq
+
+    operation = match['meth'][0] if match['meth'] else match['op'][0] if match['op'] else 'eq'
+    return FilterPlan(relations=tuple(relations), clauses=clauses, columns=columns, compare=compare, operation=operation)
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def _compile_explain(element, compiler, **kw):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
 
 
 class Repository():
     model = TypeVar('model', bound=Type[models.Base])
     unique_key: str
     order_key_map: dict = {}
+    upsert_engine: Literal['orm', 'on_conflict'] = 'orm'
+    validator_models: tuple[Type[models.Base], ...] = ()     # nested into responses, their changes count as ours
+    max_bind_params: int = 32767
+    stats: 'FlightStatsRepository | None' = None
+    stats_key: str | None = None    # flight_stats column of our primary key, stats.params filters are answered by it
+    filters: dict[str, FilterPlan] = {}     # of the service query schema, by alias
 
     async def upsert_many(self, session: AsyncSession, data: Iterable[dict]) -> Sequence[Change]:
-        _data = {record[self.unique_key]: record for record in data}
+        """ Records stored with the same content hash are skipped, the rest are compared column by column."""
+        _data = {record[self.unique_key]: dict(record, content_hash=utils.content_hash(record)) for record in data}
+        for key in await self._unchanged(session, _data):
+            del _data[key]
+
+        if self.upsert_engine == 'on_conflict':
+            changelog = await self._upsert_on_conflict(session, list(_data.values()))
+        else:
+            changelog = await self._upsert_orm(session, _data)
+
+        await self._update_changelog(session, changelog)
+        return changelog
+
+    async def _unchanged(self, session: AsyncSession, _data: dict) -> set:
+        """ Keys of the records whose content hash is stored already, looked up through the unique key index."""
+        key = getattr(self.model, self.unique_key)
+        unchanged = set()
+        for chunk in utils.chunked(_data.items(), self.max_bind_params // 2):
+            query = select(key).filter(tuple_(key, self.model.content_hash).in_([(k, record['content_hash']) for k, record in chunk]))
+            unchanged.update((await session.execute(query)).scalars())
+        return unchanged
+
+    async def _upsert_orm(self, session: AsyncSession, _data: dict) -> list[Change]:
         changelog = []
 
         exists_query = (
@@ -39,32 +147,139 @@ class Repository():
                 if (old_val := getattr(model, col_name)) != (new_val := record[col_name]):
                     setattr(model, col_name, new_val)
                     changelog.append(Change(model=model, old_val=old_val, field=col_name))
+            model.content_hash = record['content_hash']
             _data.pop(getattr(model, self.unique_key))
 
         new_models = [self.model(**record) for record in _data.values()]
         session.add_all(new_models)
 
-        await self._update_changelog(session, changelog)
         return changelog
 
-    async def get_many_ids(self,
-                           session: AsyncSession,
-                           order_by: str | None = None,
-                           order_type: Literal['asc', 'desc'] = 'asc',
-                           **params
-                           ) -> Sequence:
+    async def _upsert_on_conflict(self, session: AsyncSession, records: list[dict]) -> list[Change]:
+        """ INSERT ... ON CONFLICT DO UPDATE of rows that are distinct from the stored ones.
+        Old values come from a CTE over the same snapshot, so changes are detected from RETURNING rows only.
+        """
+        if not records:
+            return []
 
-        order_by = self._order_parse(order_by)
-        query = select(self._model_pk, order_by).distinct().order_by(getattr(order_by, order_type)())
-        query, joins = self._add_filters(query, params)
+        await session.flush()   # pending referenced entities must exist before the statement runs
 
-        if order_by.parent.class_ is not self.model and order_by.parent.class_ not in joins:
-            query = query.join(order_by.parent.class_)
+        table = self.model.__table__
+        key = table.c[self.unique_key]
+        columns = [name for name in self._update_columns if name in records[0]]
+        changelog = []
+
+        for chunk in utils.chunked(records, max(1, self.max_bind_params // (len(records[0]) + 1))):
+            insert_query = pg_insert(table).values(chunk)
+            excluded = insert_query.excluded
+            if columns:
+                upsert_query = insert_query.on_conflict_do_update(
+                    index_elements=[key],
+                    set_={**{name: excluded[name] for name in columns}, 'content_hash': excluded.content_hash, 'updated_at': func.now()},
+                    # rows stored before hashing get their hash once, without a changelog entry
+                    where=or_(
+                        tuple_(*(table.c[name] for name in columns)).is_distinct_from(tuple_(*(excluded[name] for name in columns))),
+                        table.c.content_hash.is_distinct_from(excluded.content_hash),
+                    ),
+                )
+            else:
+                upsert_query = insert_query.on_conflict_do_nothing(index_elements=[key])
+
+            old = select(table).filter(key.in_([record[self.unique_key] for record in chunk])).cte('stored')
+            upserted = upsert_query.returning(*table.c).cte('upserted')
+            query = (
+                select(upserted, old.c[key.name].is_not(None).label('old__exists'), *(old.c[name].label(f'old__{name}') for name in columns))
+                .outerjoin(old, old.c[key.name] == upserted.c[key.name])
+            )
+
+            rows = (await session.execute(query)).all()
+            for row in rows:
+                if not row.old__exists:
+                    continue
+                for name in columns:
+                    if (old_val := getattr(row, f'old__{name}')) != getattr(row, name):
+                        changelog.append(Change(model=row, old_val=old_val, field=name))
+            await self._update_aggregates(session, rows)
 
-        resp = await session.execute(query)
-        ids = resp.scalars().all()
+        return changelog
+
+    async def get_page(self,
+                       session: AsyncSession,
+                       limit: int,
+                       offset: int = 0,
+                       count: CountMode = CountMode.exact,
+                       include: set | None = None,
+                       exclude: set | None = None,
+                       order_by: str | None = None,
+                       order_type: Literal['asc', 'desc'] = 'asc',
+                       render: ColumnElement | None = None,
+                       fields: Collection[str] | None = None,
+                       **params
+                       ) -> tuple[Sequence[model], int | None]:
+        """ Filters, orders, limits and eager-loads a page in one statement, exact total rides along as a window count.
+        With render the page holds rows of its value as json instead of models, with fields models load only them.
+        """
+
+        ids = self._ids_query(order_by, order_type, **params).order_by(None).subquery()
+        total_column = func.count().over() if count == CountMode.exact else null()
+        page = (
+            select(ids.c.pk, ids.c.order_key, total_column.label('total'))
+            .order_by(getattr(ids.c.order_key, order_type)(), getattr(ids.c.pk, order_type)())
+            .limit(limit)
+            .offset(offset)
+            .subquery()
+        )
+        query = (
+            select(self._entity(render), page.c.total)
+            .join(page, self._model_pk == page.c.pk)
+            .order_by(getattr(page.c.order_key, order_type)(), getattr(page.c.pk, order_type)())
+        )
+        rows = (await session.execute(self._load(query, render, include, exclude, fields))).unique().all()
+        models = [row[0] for row in rows] if render is None else rows
+
+        if count == CountMode.exact and (rows or offset == 0):
+            total = rows[0].total if rows else 0
+        else:
+            total = await self.count(session, mode=count, order_by=order_by, order_type=order_type, **params)
+
+        return models, total
+
+    async def count(self,
+                    session: AsyncSession,
+                    mode: CountMode = CountMode.exact,
+                    order_by: str | None = None,
+                    order_type: Literal['asc', 'desc'] = 'asc',
+                    **params
+                    ) -> int | None:
+
+        if mode == CountMode.none:
+            return None
+
+        query = self._ids_query(order_by, order_type, **params).order_by(None)
+        if mode == CountMode.estimate:
+            plan = (await session.execute(Explain(query))).scalar_one()
+            return int(plan[0]['Plan']['Plan Rows'])
+
+        return (await session.execute(select(func.count()).select_from(query.subquery()))).scalar_one()
+
+    async def validator(self, session: AsyncSession, id: Any | None = None, count: CountMode = CountMode.exact, **params) -> Validator:
+        """ Count and latest updated_at of one entity or of the filtered set, including nested reference tables,
+        whose own latest updated_at is references_modified. The count is exact or skipped as the page total is.
+        """
+
+        related = [select(func.max(model.updated_at)).correlate(None).scalar_subquery() for model in self.validator_models]
+        query = select(
+            func.count(self._model_pk.distinct()) if count == CountMode.exact else null(),
+            func.greatest(func.max(self.model.updated_at), *related),
+            func.greatest(*related) if related else null(),
+        )
+        if id is not None:
+            query = query.filter(self._model_pk == id)
+        else:
+            query, _ = self._add_filters(query, params)
 
-        return ids
+        count, last_modified, references_modified = (await session.execute(query)).one()
+        return Validator(count=count, last_modified=last_modified, references_modified=references_modified)
 
     async def get_many(self,
                        session: AsyncSession,
@@ -73,6 +288,8 @@ class Repository():
                        exclude: set | None = None,
                        order_by: Any | None = None,
                        order_type: Literal['asc', 'desc'] = 'asc',
+                       render: ColumnElement | None = None,
+                       fields: Collection[str] | None = None,
                        **kw
                        ) -> Sequence[model]:
 
@@ -81,40 +298,187 @@ class Repository():
 
         order_by = self._order_parse(order_by)
         query = (
-            select(self.model)
+            select(self._entity(render))
             .order_by(getattr(order_by, order_type)())
-            .options(*(joinedload(getattr(self.model, field)) for field in include or []))
-            .options(*(noload(getattr(self.model, field)) for field in exclude or []))
             .filter(self._model_pk.in_(ids))
         )
+        if render is not None:
+            query = query.add_columns(self._model_pk)
 
         if order_by.parent.class_ is not self.model:
             query = query.join(order_by.parent.class_)
 
-        models = (await session.execute(query)).scalars().all()
-        return models
+        result = await session.execute(self._load(query, render, include, exclude, fields))
+        return result.scalars().all() if render is None else result.all()
+
+    async def get_many_keyset(self,
+                              session: AsyncSession,
+                              cursor: utils.Cursor,
+                              limit: int,
+                              include: set | None = None,
+                              exclude: set | None = None,
+                              order_by: str | None = None,
+                              order_type: Literal['asc', 'desc'] = 'asc',
+                              render: ColumnElement | None = None,
+                              fields: Collection[str] | None = None,
+                              **params
+                              ) -> Sequence[model]:
+        """ Returns up to limit + 1 models following the cursor position in the direction of travel,
+        or rows of the render json and the keyset columns.
+        """
+
+        keys = self._keyset_keys(order_by)
+        ascending = (order_type == 'asc') is (cursor.direction == 'next')
+        query = (
+            select(self._entity(render))
+            .order_by(*(key.asc() if ascending else key.desc() for key in keys))
+            .limit(limit + 1)
+        )
+        if render is not None:
+            query = query.add_columns(*keys)
+
+        if cursor.values is not None:
+            if len(cursor.values) != len(keys):
+                raise errors.INVALID_CURSOR
+            try:
+                bound = tuple_(*(self._cursor_value(key, val) for key, val in zip(keys, cursor.values)))
+            except (TypeError, ValueError):
+                raise errors.INVALID_CURSOR
+            position = tuple_(*keys)
+            query = query.filter(position > bound if ascending else position < bound)
+
+        query, _ = self._add_filters(query, params)
+
+        if fields is not None:
+            fields = {*fields, *(key.key for key in keys)}     # read back for the cursors
+        result = (await session.execute(self._load(query, render, include, exclude, fields))).unique()
+        return result.scalars().all() if render is None else result.all()
+
+    async def stream_many(self,
+                          session: AsyncSession,
+                          order_by: str | None = None,
+                          order_type: Literal['asc', 'desc'] = 'asc',
+                          yield_per: int = 1000,
+                          include: set | None = None,
+                          exclude: set | None = None,
+                          fields: Collection[str] | None = None,
+                          **params
+                          ) -> AsyncIterator[model]:
+        """ Server-side cursor over all matching models, fetched yield_per rows at a time."""
 
-    async def get_one(self, session: AsyncSession, id: str, join_relations: tuple | None = None) -> model | None:
+        order_by = self._order_parse(order_by)
+        query = (
+            select(self.model)
+            .order_by(getattr(order_by, order_type)(), getattr(self._model_pk, order_type)())
+            .execution_options(yield_per=yield_per)
+        )
+        query, joins = self._add_filters(query, params)
+
+        if order_by.parent.class_ is not self.model and order_by.parent.class_ not in joins:
+            query = query.join(order_by.parent.class_)
+
+        async for model in await session.stream_scalars(self._load(query, None, include, exclude, fields)):
+            yield model
+
+    def keyset_values(self, model, order_by: str | None = None) -> tuple:
+        return tuple(getattr(model, key.key) for key in self._keyset_keys(order_by))
+
+    async def get_one(self,
+                      session: AsyncSession,
+                      id: str,
+                      join_relations: tuple | None = None,
+                      exclude: tuple | None = None,
+                      ) -> model | None:
         query = (
             select(self.model)
             .filter(self._model_pk == id)
             .options(*(joinedload(getattr(self.model, rel_field)) for rel_field in join_relations or []))
+            .options(*(noload(getattr(self.model, rel_field)) for rel_field in exclude or []))
         )
 
         model = (await session.execute(query)).unique().scalar_one_or_none()
         return model
 
+    def _entity(self, render: ColumnElement | None):
+        # as text, the driver would parse json into python objects
+        return self.model if render is None else cast(render, Text).label('json')
+
+    def _load(self, query, render: ColumnElement | None, include: set | None, exclude: set | None, fields: Collection[str] | None = None):
+        """ Loader options of the selected model, rendered rows have no relationships to load."""
+        if render is not None:
+            return query
+        query = (
+            query
+            .options(*(joinedload(getattr(self.model, field)) for field in include or []))
+            .options(*(noload(getattr(self.model, field)) for field in exclude or []))
+        )
+        if fields is not None:
+            query = query.options(*self._fieldset(fields))
+        return query
+
+    def _fieldset(self, fields: Collection[str]) -> tuple:
+        """ load_only of the requested columns and of the keys of the requested relationships, noload of the other relationships."""
+        mapper = inspect(self.model)
+        relationships = [relationship for relationship in mapper.relationships if relationship.key in fields]
+        columns = {
+            *(name for name in fields if name in mapper.column_attrs),
+            *(mapper.get_property_by_column(column).key for relationship in relationships for column in relationship.local_columns),
+        }
+        return (
+            load_only(*(getattr(self.model, name) for name in columns)),
+            *(noload(getattr(self.model, relationship.key)) for relationship in mapper.relationships if relationship.key not in fields),
+        )
+
     @cached_property
     def _model_pk(self):
         return getattr(self.model, inspect(self.model).primary_key[0].name)
 
     @cached_property
     def _update_columns(self) -> tuple[str]:
-        return utils.get_columns(self.model, exclude={'created_at', 'updated_at'})
+        return utils.get_columns(self.model, exclude={'created_at', 'updated_at', 'content_hash'})
 
     async def _update_changelog(self, session: AsyncSession, changelog: Sequence[Change]) -> None:
         ...
 
+    async def _update_aggregates(self, session: AsyncSession, rows: Sequence) -> None:
+        """ Rows inserted or changed by an on_conflict upsert, with old__ values of the changed ones."""
+        ...
+
+    def _ids_query(self, order_by: str | None, order_type: Literal['asc', 'desc'], **params):
+        order_by = self._order_parse(order_by)
+        query = (
+            select(self._model_pk.label('pk'), order_by.label('order_key'))
+            .distinct()
+            .order_by(getattr(order_by, order_type)())
+        )
+        query, joins = self._add_filters(query, params)
+
+        if order_by.parent.class_ is not self.model and order_by.parent.class_ not in joins:
+            query = query.join(order_by.parent.class_)
+
+        return query
+
+    def _keyset_keys(self, order_by: str | None) -> tuple:
+        order_by = self._order_parse(order_by)
+        if order_by.parent.class_ is not self.model:
+            raise ValueError(f'Keyset paging requires own column of {self.model.__name__}, got {order_by}')
+
+        return (order_by, self._model_pk) if order_by is not self._model_pk else (order_by,)
+
+    @staticmethod
+    def _cursor_value(key, value):
+        """ Cursor value checked against the python type of its keyset column, as encode_cursor wrote it."""
+        python_type = key.type.python_type
+        if value is None:
+            return value
+        if python_type is datetime:
+            return datetime.fromisoformat(value)
+        if issubclass(python_type, Enum):
+            return python_type(value)
+        if isinstance(value, bool) is not (python_type is bool) or not isinstance(value, python_type):
+            raise TypeError(f'{key} expects {python_type.__name__}, got {value!r}')
+        return value
+
     def _order_parse(self, order: str | None):
         return (
                 self.order_key_map.get(order)
@@ -122,37 +486,42 @@ class Repository():
                 or self._model_pk
         )
 
+    def compile_filters(self, schema: Type[BaseModel]) -> dict[str, FilterPlan]:
+        """ Resolves every filter alias of a query schema into filters, bad aliases fail on import."""
+        self.filters = {
+            alias: compile_filter(self.model, alias)
+            for alias in (field.serialization_alias or name for name, field in schema.model_fields.items())
+            if alias not in self._stats_params
+        }
+        return self.filters
+
+    @property
+    def _stats_params(self) -> tuple[str, ...]:
+        return self.stats.params if self.stats_key is not None else ()
+
     def _add_filters(self, query, params: dict):
         filters = []
         joins = {}
-        match = {}
+
+        stats_params = {key: params[key] for key in self._stats_params if params.get(key) is not None}
+        if stats_params:
+            filters.append(self._model_pk.in_(self.stats.matching(self.stats_key, **stats_params)))
 
         for key, val in params.items():
-            if val is None:
+            if val is None or key in stats_params:
                 continue
 
-            match = regex.fullmatch(patterns.relation_alias, key).capturesdict()
-
-            relations = [getattr(models, rel) for rel in match['relations']]
-            relation_model = relations[-1] if relations else self.model
-
-            sub_filters = []
-            for field in match['fields']:
-                if match['meth']:
-                    sub_filters.append(getattr(getattr(relation_model, field), match['meth'][0])(val))
-                elif match['op']:
-                    sub_filters.append(getattr(operator, match['op'][0])(getattr(relation_model, field), val))
-                else:
-                    sub_filters.append(getattr(relation_model, field) == val)
-
-            for rel in relations:
-                joins[rel] = None
+            plan = compile_filter(self.model, key)
+            for rel in plan.relations:
+                joins.setdefault(rel, ())
+            if plan.clauses:
+                joins[plan.relations[-1]] = plan.clauses
 
-            filters.append(or_(*sub_filters))
+            filters.append(plan.bind(val))
 
-        for e, j in enumerate(joins):
-            if e == len(joins) - 1 and (clauses := match.get('clauses')):
-                query = query.join(j, or_(self._model_pk == getattr(j, clause) for clause in clauses))
+        for j, clauses in joins.items():
+            if clauses:
+                query = query.join(j, or_(*(self._model_pk == clause for clause in clauses)))
             else:
                 query = query.join(j)
         query = query.filter(and_(True, *filters))
@@ -160,6 +529,89 @@ class Repository():
         return query, joins
 
 
+class FlightStatsRepository:
+    """ Daily flight counts by route airport, company and direction, kept up to date by on_conflict flight upserts."""
+    model = models.FlightStatsModel
+    params = ('date_start', 'date_end', 'airport', 'company', 'direction')
+    max_bind_params: int = 32767
+
+    @staticmethod
+    def keys(sked_local: datetime | None, mar1_iata: str | None, mar2_iata: str | None, company_iata: str, direction) -> list[tuple]:
+        """ Aggregate keys a flight is counted in, none without sked_local."""
+        if sked_local is None:
+            return []
+        day = sked_local.astimezone(timezone.utc).date()
+        return [(day, airport, company_iata, direction) for airport in {mar1_iata, mar2_iata} - {None} or {None}]
+
+    async def apply(self, session: AsyncSession, deltas: Mapping[tuple, int]) -> None:
+        """ Adds the deltas to the counts of their keys. Sorted keys keep concurrent upserts from deadlocking."""
+        columns = ('day', 'airport_iata', 'company_iata', 'direction')
+        rows = [
+            dict(zip(columns, key), flight_count=delta)
+            for key, delta in sorted(deltas.items(), key=lambda item: str(item[0]))
+            if delta
+        ]
+
+        table = self.model.__table__
+        for chunk in utils.chunked(rows, self.max_bind_params // (len(columns) + 1)):
+            query = pg_insert(table).values(chunk)
+            await session.execute(query.on_conflict_do_update(
+                index_elements=[table.c[name] for name in columns],
+                set_={'flight_count': table.c.flight_count + query.excluded.flight_count},
+            ))
+
+    def matching(self,
+                 key: Literal['airport_iata', 'company_iata'],
+                 date_start: datetime,
+                 date_end: datetime,
+                 airport: str | None = None,
+                 company: str | None = None,
+                 direction: str | None = None,
+                 ):
+        """ Distinct airports or companies with flights sked within [date_start, date_end],
+        whole UTC days are read from the aggregate and only the partial days at the edges from flights.
+        """
+        stats, flights = self.model, models.FlightModel
+        first_day = _utc_midnight(date_start)
+        if first_day < date_start:
+            first_day += timedelta(days=1)
+        last_day = _utc_midnight(date_end) - timedelta(days=1)
+
+        if first_day <= last_day:
+            edges = [
+                and_(flights.sked_local >= date_start, flights.sked_local < first_day),
+                flights.sked_local.between(last_day + timedelta(days=1), date_end),
+            ]
+        else:
+            edges = [flights.sked_local.between(date_start, date_end)]
+        flight_columns = (flights.mar1_iata, flights.mar2_iata) if key == 'airport_iata' else (flights.company_iata,)
+
+        queries = [
+            select(column).filter(
+                edge,
+                *([or_(flights.mar1_iata == airport, flights.mar2_iata == airport)] if airport is not None else []),
+                *([flights.company_iata == company] if company is not None else []),
+                *([flights.direction == direction] if direction is not None else []),
+            )
+            for edge in edges
+            for column in flight_columns
+        ]
+        if first_day <= last_day:
+            queries.append(select(getattr(stats, key)).filter(
+                stats.day.between(first_day.date(), last_day.date()),
+                stats.flight_count > 0,
+                *([stats.airport_iata == airport] if airport is not None else []),
+                *([stats.company_iata == company] if company is not None else []),
+                *([stats.direction == direction] if direction is not None else []),
+            ))
+
+        return union(*queries)
+
+
+def _utc_midnight(value: datetime) -> datetime:
+    return value.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
 class AircraftRepository(Repository):
     model = models.AircraftModel
     unique_key = 'name'
@@ -173,6 +625,7 @@ class CountryRepository(Repository):
 class CityRepository(Repository):
     model = models.CityModel
     unique_key = 'name'
+    validator_models = (models.CountryModel,)
 
 
 class AirportRepository(Repository):
@@ -182,19 +635,309 @@ class AirportRepository(Repository):
         city_name=models.CityModel.name,
         city_name_ru=models.CityModel.name_ru,
     )
+    validator_models = (models.CityModel, models.CountryModel)
+    stats = FlightStatsRepository()
+    stats_key = 'airport_iata'
 
 
 class CompanyRepository(Repository):
     model = models.CompanyModel
     unique_key = 'iata'
+    stats = FlightStatsRepository()
+    stats_key = 'company_iata'
 
 
 class FlightRepository(Repository):
     model = models.FlightModel
     changelog_model = models.FlightsChangelogModel
     unique_key = 'orig_id'
+    upsert_engine = 'on_conflict'
+    validator_models = (models.CompanyModel, models.AircraftModel, models.AirportModel, models.CityModel, models.CountryModel)
+    stats = FlightStatsRepository()
+    archive = FlightArchive(settings.ARCHIVE_DIR)
+
+    async def get_one(self, session: AsyncSession, id: Any, join_relations: tuple | None = None, exclude: tuple | None = None):
+        flight = await super().get_one(session, id, join_relations=join_relations, exclude=exclude)
+        if flight is None:
+            return self.archive.get(id, changelog='changelog' in (join_relations or ()))
+        return flight
+
+    async def get_many(self, session: AsyncSession, ids, render: ColumnElement | None = None, **kw) -> Sequence:
+        """ Flights by ids, the missing ones from the archive unless rendered by the database."""
+        flights = await super().get_many(session, ids, render=render, **kw)
+        if render is None and (missing := set(ids) - {flight.id for flight in flights}):
+            flights = [*flights, *self.archive.get_many(missing).values()]
+        return flights
+
+    async def get_page(self,
+                       session: AsyncSession,
+                       limit: int,
+                       offset: int = 0,
+                       count: CountMode = CountMode.exact,
+                       include: set | None = None,
+                       exclude: set | None = None,
+                       order_by: str | None = None,
+                       order_type: Literal['asc', 'desc'] = 'asc',
+                       render: ColumnElement | None = None,
+                       fields: Collection[str] | None = None,
+                       **params
+                       ) -> tuple[Sequence, int | None]:
+        """ Dates before the hot window are paged together with the archive and never rendered by the database."""
+        if render is not None or not self.reads_archive(params):
+            return await super().get_page(
+                session, limit, offset, count, include, exclude, order_by, order_type, render, fields, **params
+            )
+
+        flights = await self._with_archived(session, order_by, order_type, params, include, exclude, fields)
+        total = len(flights) if count != CountMode.none else None     # all of them are read, estimate is exact too
+        return [self._model(flight) for flight in flights[offset:offset + limit]], total
+
+    async def get_many_keyset(self,
+                              session: AsyncSession,
+                              cursor: utils.Cursor,
+                              limit: int,
+                              include: set | None = None,
+                              exclude: set | None = None,
+                              order_by: str | None = None,
+                              order_type: Literal['asc', 'desc'] = 'asc',
+                              render: ColumnElement | None = None,
+                              fields: Collection[str] | None = None,
+                              **params
+                              ) -> Sequence:
+        if render is not None or not self.reads_archive(params):
+            return await super().get_many_keyset(
+                session, cursor, limit, include, exclude, order_by, order_type, render, fields, **params
+            )
+
+        flights = await self._with_archived(session, order_by, order_type, params, include, exclude, fields)
+        if cursor.direction == 'prev':
+            flights = flights[::-1]
+        if cursor.values is not None:
+            keys = self._keyset_keys(order_by)
+            if len(cursor.values) != len(keys):
+                raise errors.INVALID_CURSOR
+            try:
+                bound = tuple(self._cursor_value(key, val) for key, val in zip(keys, cursor.values))
+            except (TypeError, ValueError):
+                raise errors.INVALID_CURSOR
+            ascending = (order_type == 'asc') is (cursor.direction == 'next')
+            flights = [flight for flight in flights if (self._position(flight, keys) > bound if ascending else self._position(flight, keys) < bound)]
+        return [self._model(flight) for flight in flights[:limit + 1]]
+
+    async def validator(self, session: AsyncSession, id: Any | None = None, count: CountMode = CountMode.exact, **params) -> Validator:
+        validator = await super().validator(session, id=id, count=count, **params)
+        if id is not None:
+            if validator.count or (flight := self.archive.get(id)) is None:
+                return validator
+            return validator._replace(count=1, last_modified=flight.updated_at)
+
+        if not self.reads_archive(params):
+            return validator
+        archived = [flight for flight in self.archive.flights(*self._sked_range(params)) if self._matches(flight, params)]
+        last_modified = max((flight['updated_at'] for flight in archived), default=None)
+        return validator._replace(
+            count=validator.count + len(archived) if validator.count is not None else None,
+            last_modified=max(filter(None, (validator.last_modified, last_modified)), default=None),
+        )
+
+    async def delays(self,
+                     session: AsyncSession,
+                     group_by: Literal['company', 'destination', 'hour', 'day'],
+                     actual: Literal['at_local', 'otpr', 'takeoff_et'] = 'at_local',
+                     on_time: int = 15,
+                     tz: str = 'UTC',
+                     **params
+                     ) -> Sequence:
+        """ Delay distribution in minutes per group of the filtered flights, aggregated by PostgreSQL.
+        Percentiles come from one ordered-set aggregate, so every group is sorted once.
+        """
+        flights = self.model
+        local = func.timezone(tz, flights.sked_local)
+        key = dict(
+            company=flights.company_iata,
+            # the route starts at mar1, the other airport of a departure is the next one
+            destination=case((flights.direction == Direction.departure, flights.mar2_iata), else_=flights.mar1_iata),
+            hour=cast(extract('hour', local), Integer),
+            day=cast(local, Date),
+        )[group_by]
+        matching = (
+            select(key.label('key'), cast(extract('epoch', getattr(flights, actual) - flights.sked_local) / 60, Float).label('delay'))
+            .filter(getattr(flights, actual).is_not(None), flights.sked_local.is_not(None))
+        )
+        matching = self._add_filters(matching, params)[0].subquery()
+
+        query = (
+            select(
+                matching.c.key,
+                func.count(),
+                func.avg(matching.c.delay),
+                func.percentile_cont(pg_array([0.5, 0.9, 0.99])).within_group(matching.c.delay),
+                cast(func.count().filter(matching.c.delay <= on_time), Float) / func.count(),
+            )
+            .group_by(matching.c.key)
+            .order_by(matching.c.key)
+        )
+        return (await session.execute(query)).all()
+
+    async def archive_month(self, session: AsyncSession, month: date) -> int:
+        """ Moves flights sked within a UTC month and their changelog into the archive, returns the number of flights.
+        The file is written before the rows are deleted, rows left in both places are read from the database.
+        """
+        flights, changelog = self.model.__table__, self.changelog_model.__table__
+        start, end = (datetime(m.year, m.month, 1, tzinfo=timezone.utc) for m in (month, add_months(month, 1)))
+        rows = (await session.execute(select(flights).filter(flights.c.sked_local >= start, flights.c.sked_local < end))).mappings().all()
+        if not rows:
+            return 0
+
+        ids = [row['id'] for row in rows]
+        entries = []
+        for chunk in utils.chunked(ids, self.max_bind_params):
+            entries.extend((await session.execute(select(changelog).filter(changelog.c.flight_id.in_(chunk)))).mappings().all())
+        self.archive.write(month, [dict(row) for row in rows], [dict(entry) for entry in entries])
+
+        for chunk in utils.chunked(ids, self.max_bind_params):
+            await session.execute(delete(changelog).filter(changelog.c.flight_id.in_(chunk)))
+            await session.execute(delete(flights).filter(flights.c.id.in_(chunk)))
+        return len(rows)
+
+    async def _with_archived(self,
+                             session: AsyncSession,
+                             order_by: str | None,
+                             order_type: Literal['asc', 'desc'],
+                             params: dict,
+                             include: set | None = None,
+                             exclude: set | None = None,
+                             fields: Collection[str] | None = None,
+                             ) -> list:
+        """ Stored and archived flights matching params in order, stored ones win over archived with the same orig_id.
+        The range of a flights query is at most a week, so all of them are read and paged here.
+        """
+        keys = self._keyset_keys(order_by)
+        if fields is not None:
+            fields = {*fields, 'orig_id', *(key.key for key in keys)}      # read back to merge and order
+        stored = [
+            flight async for flight in
+            self.stream_many(session, order_by=order_by, order_type=order_type, include=include, exclude=exclude, fields=fields, **params)
+        ]
+        orig_ids = {flight.orig_id for flight in stored}
+        archived = [
+            flight for flight in self.archive.flights(*self._sked_range(params))
+            if flight['orig_id'] not in orig_ids and self._matches(flight, params)
+        ]
+        return sorted([*stored, *archived], key=lambda flight: self._position(flight, keys), reverse=order_type == 'desc')
+
+    def reads_archive(self, params: dict) -> bool:
+        """ Whether the sked_local range of params starts before the hot window."""
+        return self.archive.covers(self._sked_range(params)[0])
+
+    def _sked_range(self, params: dict) -> tuple[datetime | None, datetime | None]:
+        """ sked_local bounds among the filters of params, other keys as order_by are skipped."""
+        bounds = {}
+        for key, value in params.items():
+            if (plan := self.filters.get(key)) is None:
+                continue
+            if len(plan.columns) == 1 and plan.columns[0] is self.model.sked_local and plan.operation in ('ge', 'le'):
+                bounds[plan.operation] = value
+        return bounds.get('ge'), bounds.get('le')
+
+    def _matches(self, flight: dict, params: dict) -> bool:
+        """ Filters of params evaluated over an archived row."""
+        return all(
+            compile_filter(self.model, key).test(lambda column: flight[self._local_keys[column.class_, column.key]], value)
+            for key, value in params.items()
+            if value is not None
+        )
+
+    @cached_property
+    def _local_keys(self) -> dict[tuple, str]:
+        """ Own column holding each filterable column, as company_iata for CompanyModel.iata."""
+        keys = {(self.model, column.key): column.key for column in self.model.__table__.columns}
+        referenced = Counter((fk.column.table, fk.column.key) for fk in self.model.__table__.foreign_keys)
+        for fk in self.model.__table__.foreign_keys:
+            if referenced[fk.column.table, fk.column.key] == 1:
+                model = next(mapper.class_ for mapper in models.Base.registry.mappers if mapper.local_table is fk.column.table)
+                keys[model, fk.column.key] = fk.parent.key
+        return keys
+
+    @staticmethod
+    def _position(flight: Any, keys: Sequence) -> tuple:
+        return tuple(flight[key.key] if isinstance(flight, dict) else getattr(flight, key.key) for key in keys)
+
+    def _model(self, flight: Any) -> models.FlightModel:
+        return self.archive.model(flight) if isinstance(flight, dict) else flight
 
     async def _update_changelog(self, session: AsyncSession, changelog: Sequence[Change]) -> None:
-        flights_changelog = [self.changelog_model(field=c.field, old_value=c.old_val, flight=c.model)
-                             for c in changelog]
-        session.add_all(flights_changelog)
+        """ Multi-row INSERT straight into the table, bypassing the unit of work."""
+        rows = [dict(flight_id=c.model.id, field=c.field, old_value=c.old_val) for c in changelog]
+
+        for chunk in utils.chunked(rows, self.max_bind_params // 3):
+            await session.execute(insert(self.changelog_model.__table__).values(chunk))
+
+    async def _update_aggregates(self, session: AsyncSession, rows: Sequence) -> None:
+        """ Counts new flights in and moves changed ones between the flight_stats keys."""
+        deltas = Counter()
+        for row in rows:
+            for key in self.stats.keys(row.sked_local, row.mar1_iata, row.mar2_iata, row.company_iata, row.direction):
+                deltas[key] += 1
+            if row.old__exists:
+                old = [getattr(row, f'old__{name}') for name in ('sked_local', 'mar1_iata', 'mar2_iata', 'company_iata', 'direction')]
+                for key in self.stats.keys(*old):
+                    deltas[key] -= 1
+        await self.stats.apply(session, deltas)
+
+
+class SearchRepository:
+    """ Typeahead over reference names, served by the pg_trgm GIN indexes."""
+    targets = (
+        ('airport', models.AirportModel.iata, models.AirportModel.name, models.AirportModel.name_ru),
+        ('city', models.CityModel.name, models.CityModel.name, models.CityModel.name_ru),
+        ('company', models.CompanyModel.iata, models.CompanyModel.name, None),
+    )
+
+    async def validator(self, session: AsyncSession) -> Validator:
+        tables = {code.class_ for _, code, _, _ in self.targets}
+        query = select(
+            sum((select(func.count()).select_from(table).scalar_subquery() for table in tables), start=literal(0)),
+            func.greatest(*(select(func.max(table.updated_at)).scalar_subquery() for table in tables)),
+        )
+        count, last_modified = (await session.execute(query)).one()
+        return Validator(count=count, last_modified=last_modified)
+
+    async def search(self, session: AsyncSession, text: str, limit: int, kinds: Iterable[str] | None = None) -> Sequence:
+        pattern = '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+        queries = []
+        for kind, code, name, name_ru in self.targets:
+            if kinds and kind not in kinds:
+                continue
+
+            names = [column for column in (name, name_ru) if column is not None]
+            score = (
+                func.coalesce(func.greatest(*(func.word_similarity(text, column) for column in names)), 0)    # of unnamed rows
+                + case((func.upper(code) == text.upper(), 2), else_=0)
+                + case((or_(*(column.ilike(pattern[1:]) for column in names)), 1), else_=0)
+            )
+            queries.append(
+                select(
+                    literal(kind).label('kind'),
+                    code.label('code'),
+                    name.label('name'),
+                    (name_ru if name_ru is not None else null()).label('name_ru'),
+                    score.label('score'),
+                )
+                .filter(or_(
+                    func.upper(code) == text.upper(),
+                    *(column.ilike(pattern) for column in names),
+                    *(literal(text).op('<%')(column) for column in names),
+                ))
+                .order_by(score.desc())
+                .limit(limit)
+            )
+
+        if not queries:
+            return []
+
+        matches = union_all(*queries).subquery()
+        query = select(matches).order_by(matches.c.score.desc(), matches.c.name).limit(limit)
+
+        return (await session.execute(query)).all()
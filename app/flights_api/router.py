@@ -1,12 +1,19 @@
 from typing import Annotated, Literal, Union
 
-from fastapi import APIRouter, Depends, Body
+from fastapi import APIRouter, Depends, Body, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 
 from . import errors
+from . import ingestion
 from . import services
+from .fields import CountMode
+from ..config import settings
+from ..response_cache import response_cache
 from . import (
     schemas,
-    dependencies
+    dependencies,
+    serializers,
+    utils,
 )
 
 
@@ -18,21 +25,31 @@ async def upsert_aircrafts(
         session: dependencies.async_session,
         aircrafts: list[schemas.AircraftDBSchema]
 ):
+    response_cache.invalidate_on_commit(session, 'aircrafts')
     await services.AircraftService.upsert_many(session, aircrafts)
 
 
 @airport_router.get('/aircrafts/', response_model=schemas.AircraftPagedResponseSchema, tags=['Aircrafts'])
 async def get_aircrafts(
         session: dependencies.async_session,
+        request: Request,
+        response: Response,
         paging: Annotated[schemas.PagingSchema, Depends()],
         params: Annotated[schemas.AircraftQuerySchema, Depends()],
+        fieldset: Annotated[schemas.AircraftFieldsetSchema, Depends()],
 ):
-    return await services.AircraftService.get_many(
+    filters = params.model_dump(by_alias=True, exclude_none=True)
+    headers = utils.check_not_modified(request, response, await services.AircraftService.validator(session, count=paging.count, **filters))
+
+    page = await services.AircraftService.get_many(
         session,
         paging=paging,
+        fields=fieldset.selected(),
         order_by='name',
-        **params.model_dump(by_alias=True, exclude_none=True)
+        **filters
     )
+    schema = schemas.trimmed_page(schemas.AircraftPagedResponseSchema, fieldset.selected())
+    return serializers.json_response(schema, page, headers=headers)
 
 
 @airport_router.post('/aircrafts/', response_model=list[Union[schemas.AircraftResponseSchema, schemas.EmptySchema]], tags=['Aircrafts'])
@@ -46,8 +63,15 @@ async def get_aircrafts_by_id(
 @airport_router.get('/aircrafts/{name}', response_model=schemas.AircraftResponseSchema, tags=['Aircrafts'])
 async def get_aircraft(
         session: dependencies.async_session,
-        name: str
+        request: Request,
+        response: Response,
+        name: str,
 ):
+    validator = await services.AircraftService.validator(session, id=name)
+    if not validator.count:
+        raise errors.NOT_FOUND
+    utils.check_not_modified(request, response, validator)
+
     aircraft = await services.AircraftService.get_one(session=session, id=name)
     if aircraft is None:
         raise errors.NOT_FOUND
@@ -60,20 +84,30 @@ async def upsert_countries(
         session: dependencies.async_session,
         countries: list[schemas.CountryDBSchema]
 ):
+    response_cache.invalidate_on_commit(session, 'countries')
     await services.CountryService.upsert_many(session=session, data=countries)
 
 
 @airport_router.get('/countries/', response_model=schemas.CountryPagedResponseSchema, tags=['Countries'])
 async def get_countries(
         session: dependencies.async_session,
+        request: Request,
+        response: Response,
         paging: Annotated[schemas.PagingSchema, Depends()],
-        params: Annotated[schemas.CountryQuerySchema, Depends()]):
+        params: Annotated[schemas.CountryQuerySchema, Depends()],
+        fieldset: Annotated[schemas.CountryFieldsetSchema, Depends()],
+):
+    filters = params.model_dump(by_alias=True, exclude_none=True)
+    headers = utils.check_not_modified(request, response, await services.CountryService.validator(session, count=paging.count, **filters))
 
-    return await services.CountryService.get_many(
+    page = await services.CountryService.get_many(
         session,
         paging=paging,
-        **params.model_dump(by_alias=True, exclude_none=True)
+        fields=fieldset.selected(),
+        **filters
     )
+    schema = schemas.trimmed_page(schemas.CountryPagedResponseSchema, fieldset.selected())
+    return serializers.json_response(schema, page, headers=headers)
 
 
 @airport_router.post('/countries/', response_model=list[Union[schemas.CountryResponseSchema, schemas.EmptySchema]], tags=['Countries'])
@@ -87,8 +121,15 @@ async def get_countries_by_id(
 @airport_router.get('/countries/{name}', response_model=schemas.CountryResponseSchema, tags=['Countries'])
 async def get_country(
         session: dependencies.async_session,
-        name: str
+        request: Request,
+        response: Response,
+        name: str,
 ):
+    validator = await services.CountryService.validator(session, id=name)
+    if not validator.count:
+        raise errors.NOT_FOUND
+    utils.check_not_modified(request, response, validator)
+
     country = await services.CountryService.get_one(session=session, id=name)
     if country is None:
         raise errors.NOT_FOUND
@@ -101,22 +142,32 @@ async def upsert_cities(
         session: dependencies.async_session,
         cities: list[schemas.CityDBSchema]
 ):
+    response_cache.invalidate_on_commit(session, 'cities', 'countries')
     await services.CityService.upsert_many(session=session, data=cities)
 
 
 @airport_router.get('/cities/', response_model=schemas.CityPagedResponseSchema, tags=['Cities'])
 async def get_cities(
         session: dependencies.async_session,
+        request: Request,
+        response: Response,
         paging: Annotated[schemas.PagingSchema, Depends()],
         params: Annotated[schemas.CityQuerySchema, Depends()],
+        fieldset: Annotated[schemas.CityFieldsetSchema, Depends()],
         order_by: Literal['name', 'name_ru'] = 'name',
 ):
-    return await services.CityService.get_many(
+    filters = params.model_dump(by_alias=True, exclude_none=True)
+    headers = utils.check_not_modified(request, response, await services.CityService.validator(session, count=paging.count, **filters))
+
+    page = await services.CityService.get_many(
         session,
         paging=paging,
+        fields=fieldset.selected(),
         order_by=order_by,
-        **params.model_dump(by_alias=True, exclude_none=True)
+        **filters
     )
+    schema = schemas.trimmed_page(schemas.CityPagedResponseSchema, fieldset.selected())
+    return serializers.json_response(schema, page, headers=headers)
 
 
 @airport_router.post('/cities/', response_model=list[Union[schemas.CityResponseSchema, schemas.EmptySchema]], tags=['Cities'])
@@ -130,8 +181,15 @@ async def get_cities_by_id(
 @airport_router.get('/cities/{name}', response_model=schemas.CityResponseSchema, tags=['Cities'])
 async def get_city(
         session: dependencies.async_session,
-        name: str
+        request: Request,
+        response: Response,
+        name: str,
 ):
+    validator = await services.CityService.validator(session, id=name)
+    if not validator.count:
+        raise errors.NOT_FOUND
+    utils.check_not_modified(request, response, validator)
+
     city = await services.CityService.get_one(session=session, id=name)
     if city is None:
         raise errors.NOT_FOUND
@@ -144,22 +202,32 @@ async def upsert_airports(
         session: dependencies.async_session,
         airports: list[schemas.AirportDBSchema]
 ):
+    response_cache.invalidate_on_commit(session, 'airports', 'cities', 'countries')
     await services.AirportService.upsert_many(session, airports)
 
 
 @airport_router.get('/airports/', response_model=schemas.AirportPagedResponseSchema, tags=['Airports'])
 async def get_airports(
         session: dependencies.async_session,
+        request: Request,
+        response: Response,
         paging: Annotated[schemas.PagingSchema, Depends()],
         params: Annotated[schemas.AirportQuerySchema, Depends()],
+        fieldset: Annotated[schemas.AirportFieldsetSchema, Depends()],
         order_by: Literal['name', 'name_ru', 'iata', 'city_name', 'city_name_ru'] = 'name',
 ):
-    return await services.AirportService.get_many(
+    filters = params.model_dump(by_alias=True, exclude_none=True)
+    headers = utils.check_not_modified(request, response, await services.AirportService.validator(session, count=paging.count, **filters))
+
+    page = await services.AirportService.get_many(
         session,
         paging=paging,
+        fields=fieldset.selected(),
         order_by=order_by,
-        **params.model_dump(by_alias=True, exclude_none=True)
+        **filters
     )
+    schema = schemas.trimmed_page(schemas.AirportPagedResponseSchema, fieldset.selected())
+    return serializers.json_response(schema, page, headers=headers)
 
 
 @airport_router.post('/airports/', response_model=list[Union[schemas.AirportResponseSchema, schemas.EmptySchema]], tags=['Airports'])
@@ -173,8 +241,15 @@ async def get_airports_by_id(
 @airport_router.get('/airports/{iata}', response_model=schemas.AirportResponseSchema, tags=['Airports'])
 async def get_airport(
         session: dependencies.async_session,
-        iata: str
+        request: Request,
+        response: Response,
+        iata: str,
 ):
+    validator = await services.AirportService.validator(session, id=iata.upper())
+    if not validator.count:
+        raise errors.NOT_FOUND
+    utils.check_not_modified(request, response, validator)
+
     airport = await services.AirportService.get_one(session=session, id=iata.upper())
     if airport is None:
         raise errors.NOT_FOUND
@@ -187,22 +262,32 @@ async def upsert_companies(
         session: dependencies.async_session,
         companies: list[schemas.CompanyDBSchema]
 ):
+    response_cache.invalidate_on_commit(session, 'companies')
     await services.CompanyService.upsert_many(session, companies)
 
 
 @airport_router.get('/companies/', response_model=schemas.CompanyPagedResponseSchema, tags=['Companies'])
 async def get_companies(
         session: dependencies.async_session,
+        request: Request,
+        response: Response,
         paging: Annotated[schemas.PagingSchema, Depends()],
         params: Annotated[schemas.CompanyQuerySchema, Depends()],
+        fieldset: Annotated[schemas.CompanyFieldsetSchema, Depends()],
         order_by: Literal['name', 'iata'] = 'name',
 ):
-    return await services.CompanyService.get_many(
+    filters = params.model_dump(by_alias=True, exclude_none=True)
+    headers = utils.check_not_modified(request, response, await services.CompanyService.validator(session, count=paging.count, **filters))
+
+    page = await services.CompanyService.get_many(
         session,
         paging=paging,
+        fields=fieldset.selected(),
         order_by=order_by,
-        **params.model_dump(by_alias=True, exclude_none=True)
+        **filters
     )
+    schema = schemas.trimmed_page(schemas.CompanyPagedResponseSchema, fieldset.selected())
+    return serializers.json_response(schema, page, headers=headers)
 
 
 @airport_router.post('/companies/', response_model=list[Union[schemas.CompanyResponseSchema, schemas.EmptySchema]], tags=['Companies'])
@@ -216,8 +301,15 @@ async def get_companies_by_id(
 @airport_router.get('/companies/{iata}', response_model=schemas.CompanyResponseSchema, tags=['Companies'])
 async def get_company(
         session: dependencies.async_session,
-        iata: str
+        request: Request,
+        response: Response,
+        iata: str,
 ):
+    validator = await services.CompanyService.validator(session, id=iata.upper())
+    if not validator.count:
+        raise errors.NOT_FOUND
+    utils.check_not_modified(request, response, validator)
+
     company = await services.CompanyService.get_one(session=session, id=iata.upper())
     if company is None:
         raise errors.NOT_FOUND
@@ -225,28 +317,107 @@ async def get_company(
         return company
 
 
-@airport_router.put('/flights/', dependencies=[Depends(dependencies.upsert_permission)], tags=['Flights'])
+@airport_router.put(
+    '/flights/',
+    dependencies=[Depends(dependencies.upsert_permission)],
+    response_model=schemas.FlightBatchSchema | None,
+    responses={status.HTTP_202_ACCEPTED: {'model': schemas.FlightBatchSchema, 'description': 'Queued'}},
+    tags=['Flights'],
+)
 async def upsert_flights(
         session: dependencies.async_session,
+        request: Request,
+        response: Response,
         flights: list[schemas.FlightDBSchema]
 ):
+    """ With FLIGHT_INGESTION=queue the flights are applied in the background, the batch status is at `Location`."""
+    if settings.FLIGHT_INGESTION == 'queue':
+        batch = await ingestion.enqueue(session, flights)
+        response.status_code = status.HTTP_202_ACCEPTED
+        response.headers['Location'] = str(request.url_for('get_flight_batch', id=batch.id))
+        return batch
+
+    response_cache.invalidate_on_commit(session, *response_cache.namespaces)
     await services.FlightService.upsert_many(session, flights)
 
 
-@airport_router.get('/flights/', response_model=schemas.FlightPagedResponseSchema, tags=['Flights'])
+@airport_router.put(
+    '/flights/stream',
+    dependencies=[Depends(dependencies.upsert_permission)],
+    response_model=list[schemas.ChunkResultSchema],
+    tags=['Flights'],
+    openapi_extra={'requestBody': {'content': {'application/x-ndjson': {'schema': {'type': 'string'}}}, 'required': True}},
+)
+async def upsert_flights_stream(
+        session: dependencies.async_session,
+        request: Request,
+        chunk_size: Annotated[int, Query(ge=1, le=5000)] = 500,
+):
+    """ Newline-delimited flights, optionally with `Content-Encoding: gzip`. Invalid records are reported and skipped."""
+    response_cache.invalidate_on_commit(session, *response_cache.namespaces)
+    lines = utils.iter_lines(
+        request.stream(),
+        compressed=request.headers.get('content-encoding') == 'gzip',
+        max_line=settings.INGESTION_MAX_RECORD_SIZE,
+    )
+    return await services.FlightService.upsert_ndjson(session, lines, chunk_size=chunk_size)
+
+
+@airport_router.get(
+    '/flights/batches/{id}',
+    dependencies=[Depends(dependencies.upsert_permission)],
+    response_model=schemas.FlightBatchSchema,
+    tags=['Flights'],
+)
+async def get_flight_batch(
+        session: dependencies.async_session,
+        id: int,
+):
+    batch = await ingestion.get(session, id)
+    if batch is None:
+        raise errors.NOT_FOUND
+    return batch
+
+
+@airport_router.get(
+    '/flights/',
+    response_model=Union[
+        schemas.FlightPagedResponseSchema,
+        schemas.FlightCursorPagedResponseSchema,
+        schemas.FlightSideloadedPagedResponseSchema,
+        schemas.FlightSideloadedCursorPagedResponseSchema,
+    ],
+    tags=['Flights'],
+)
 async def get_flights(
         session: dependencies.async_session,
-        paging: Annotated[schemas.PagingSchema, Depends()],
+        request: Request,
+        response: Response,
+        paging: Annotated[schemas.CursorPagingSchema, Depends()],
         params: Annotated[schemas.FlightQuerySchema, Depends()],
+        fieldset: Annotated[schemas.FlightFieldsetSchema, Depends()],
         order_type: Literal['asc', 'desc'] = 'asc',
+        shape: Annotated[Literal['nested', 'sideloaded'], Query(
+            description='sideloaded: airports, companies and aircrafts by code, each of them once in `included`'
+        )] = 'nested',
 ):
-    return await services.FlightService.get_many(
+    filters = params.model_dump(by_alias=True, exclude_none=True)
+    headers = utils.check_not_modified(request, response, await services.FlightService.validator(session, count=paging.count, **filters))
+
+    get_many = services.FlightService.get_many_sideloaded if shape == 'sideloaded' else services.FlightService.get_many
+    page = await get_many(
         session,
         paging=paging,
-        **params.model_dump(by_alias=True, exclude_none=True),
+        fields=fieldset.selected(),
+        **filters,
         order_by='sked_local',
         order_type=order_type,
     )
+    if shape == 'sideloaded':
+        schema = schemas.FlightSideloadedCursorPagedResponseSchema if 'next' in page else schemas.FlightSideloadedPagedResponseSchema
+    else:
+        schema = schemas.FlightCursorPagedResponseSchema if 'next' in page else schemas.FlightPagedResponseSchema
+    return serializers.json_response(schemas.trimmed_page(schema, fieldset.selected()), page, headers=headers)
 
 
 @airport_router.post('/flights/', response_model=list[Union[schemas.FlightResponseSchema, schemas.EmptySchema]], tags=['Flights'])
@@ -254,18 +425,79 @@ async def get_flights_by_id(
         session: dependencies.async_session,
         ids: Annotated[list[int], Body(max_length=100)],
 ):
-    return await services.FlightService.get_many_by_ids(session, ids=ids)
+    flights = await services.FlightService.get_many_by_ids(session, ids=ids)
+    return serializers.json_response(list[Union[schemas.FlightResponseSchema, schemas.EmptySchema]], flights)
+
+
+@airport_router.get('/flights/export', response_class=StreamingResponse, tags=['Flights'])
+async def export_flights(
+        session: dependencies.async_session,
+        request: Request,
+        response: Response,
+        params: Annotated[schemas.FlightExportQuerySchema, Depends()],
+        format: Literal['ndjson', 'csv'] = 'ndjson',
+        order_type: Literal['asc', 'desc'] = 'asc',
+):
+    """ Streams every matching flight, the date range is not limited."""
+    filters = params.model_dump(by_alias=True, exclude_none=True)
+    # the unbounded range is not counted, the latest updated_at is enough for the ETag
+    headers = utils.check_not_modified(request, response, await services.FlightService.validator(session, count=CountMode.none, **filters))
+
+    content = services.FlightService.export(
+        format,
+        **filters,
+        order_by='sked_local',
+        order_type=order_type,
+    )
+    media_type = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+    return StreamingResponse(content, media_type=media_type, headers=headers)
+
+
+@airport_router.get('/flights/delays', response_model=list[schemas.DelayStatsSchema], tags=['Flights'])
+async def get_flight_delays(
+        session: dependencies.async_session,
+        request: Request,
+        response: Response,
+        params: Annotated[schemas.FlightExportQuerySchema, Depends()],
+        delays: Annotated[schemas.DelaysQuerySchema, Depends()],
+):
+    """ Delay distribution of the matching flights in minutes, computed by the database, the date range is not limited."""
+    filters = params.model_dump(by_alias=True, exclude_none=True)
+    headers = utils.check_not_modified(request, response, await services.FlightService.validator(session, count=CountMode.none, **filters))
+
+    groups = await services.FlightService.delays(session, delays, **filters)
+    return serializers.json_response(list[schemas.DelayStatsSchema], groups, headers=headers)
 
 
 @airport_router.get('/flights/{id}', response_model=schemas.FlightResponseSchema, tags=['Flights'])
 async def get_flight(
         session: dependencies.async_session,
+        request: Request,
+        response: Response,
         id: int,
         changelog: bool = True,
 ):
+    validator = await services.FlightService.validator(session, id=id)
+    if not validator.count:
+        raise errors.NOT_FOUND
+    utils.check_not_modified(request, response, validator)
+
     join_relations = ('changelog',) if changelog else None
     flight = await services.FlightService.get_one(session=session, id=id, join_relations=join_relations)
     if flight is None:
         raise errors.NOT_FOUND
     else:
         return flight
+
+
+@airport_router.get('/search/', response_model=list[schemas.SearchResultSchema], tags=['Search'])
+async def search(
+        session: dependencies.async_session,
+        request: Request,
+        response: Response,
+        params: Annotated[schemas.SearchQuerySchema, Depends()],
+):
+    """ Ranked typeahead over airports, cities and companies."""
+    utils.check_not_modified(request, response, await services.SearchService.validator(session))
+
+    return await services.SearchService.search(session, params)
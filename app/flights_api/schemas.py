@@ -1,6 +1,7 @@
-from datetime import datetime, timedelta
-from functools import wraps
-from typing import Annotated, Sequence
+from datetime import date, datetime, timedelta
+from functools import lru_cache, wraps
+from typing import Annotated, ClassVar, Literal, get_args
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 import regex
 from fastapi import HTTPException, status
@@ -13,11 +14,12 @@ from pydantic import (BaseModel,
                       model_validator,
                       field_serializer,
                       AwareDatetime,
+                      create_model,
                       )
 
 from . import patterns
-from .fields import Direction
-from .utils import check_timedelta
+from .fields import BatchStatus, Direction, CountMode
+from .utils import check_timedelta, decode_cursor
 
 
 @wraps(Field)
@@ -43,20 +45,142 @@ class EmptySchema(BaseModel):
 class PagingSchema(BaseModel):
     page: int = Field(0, ge=0, description='Starts with 0')
     limit: int = Field(100, ge=1, le=100)
+    count: CountMode = Field(CountMode.exact, description='How `total` is computed: exact, planner estimate or skipped')
 
-    def get_page(self, arr: Sequence):
-        start_index = self.page * self.limit
-        end_index = start_index + self.limit
+    @property
+    def offset(self) -> int:
+        return self.page * self.limit
 
-        return arr[start_index: end_index]
+
+class CursorPagingSchema(PagingSchema):
+    cursor: str | None = Field(None, description='Keyset paging: `next` or `prev` token of the previous page, empty to start')
+
+    @field_validator('cursor', mode='after')
+    @classmethod
+    def _decode_cursor(cls, cursor: str | None):
+        if cursor is not None:
+            return decode_cursor(cursor)
 
 
 class PagedResponseSchema(BaseSchema):
     items: list
     count: int
-    total: int
+    total: int | None
     page: int
-    total_pages: int
+    total_pages: int | None
+
+
+class CursorPagedResponseSchema(BaseSchema):
+    items: list
+    count: int
+    next: str | None
+    prev: str | None
+
+
+class FieldsetSchema(BaseModel):
+    item_schema: ClassVar[type[BaseModel]]
+
+    fields: str | None = Field(None, pattern=r'^\w+(,\w+)*$', description='comma separated fields of the items to return')
+    exclude: str | None = Field(None, pattern=r'^\w+(,\w+)*$', description='comma separated fields of the items to leave out')
+
+    @field_validator('fields', 'exclude', mode='after')
+    @classmethod
+    def _split(cls, names: str | None) -> list[str] | None:
+        if names is not None:
+            return names.split(',')
+
+    @model_validator(mode='after')
+    def validate_model(self):
+        unknown = {*(self.fields or ()), *(self.exclude or ())} - set(self.item_schema.model_fields)
+        if unknown:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f'Unknown fields: {", ".join(sorted(unknown))}'
+            )
+        if self.selected() == frozenset():
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='No fields left to return')
+        return self
+
+    def selected(self) -> frozenset[str] | None:
+        """ Item fields to return, None for all of them."""
+        if self.fields is None and self.exclude is None:
+            return None
+        return frozenset(self.fields or self.item_schema.model_fields) - set(self.exclude or ())
+
+
+# fieldsets come from the query string, a bounded cache keeps clients from growing it
+@lru_cache(maxsize=256)
+def trimmed(schema: type[BaseModel], fields: frozenset[str] | None) -> type[BaseModel]:
+    """ Copy of schema with the given fields only, schema itself for all of them."""
+    if fields is None:
+        return schema
+    return create_model(
+        f'{schema.__name__}Trimmed',
+        __config__=schema.model_config,
+        **{name: (field.annotation, field) for name, field in schema.model_fields.items() if name in fields},
+    )
+
+
+@lru_cache(maxsize=256)
+def trimmed_page(schema: type[BaseModel], fields: frozenset[str] | None) -> type[BaseModel]:
+    """ Paged response schema with the items trimmed to fields."""
+    if fields is None:
+        return schema
+    item_schema, = get_args(schema.model_fields['items'].annotation)
+    return create_model(f'{schema.__name__}Trimmed', __base__=schema, items=(list[trimmed(item_schema, fields)], ...))
+
+
+class RecordErrorSchema(BaseModel):
+    line: int
+    detail: list
+
+
+class ChunkResultSchema(BaseModel):
+    chunk: int
+    received: int
+    upserted: int
+    changed: int
+    errors: list[RecordErrorSchema]
+
+
+class FlightBatchSchema(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    status: BatchStatus
+    received: int
+    upserted: int | None = Field(None, description='records applied, the latest ones of their orig_id')
+    superseded: int | None = Field(None, description='records replaced by a later one of the same orig_id')
+    changed: int | None = None
+    error: str | None = None
+    created_at: AwareDatetime
+    updated_at: AwareDatetime
+
+
+class SearchQuerySchema(BaseModel):
+    q: str = Field(min_length=2, max_length=64, description='part of a name, name_ru or iata code')
+    kind: str | None = Field(None, pattern=r'^(airport|city|company)(,(airport|city|company))*$', description='comma separated kinds')
+    limit: int = Field(10, ge=1, le=50)
+
+    @field_validator('q', mode='before')
+    @classmethod
+    def _strip(cls, q):
+        # before the length check, padding must not make up the minimum
+        return q.strip() if isinstance(q, str) else q
+
+    @field_validator('kind', mode='after')
+    @classmethod
+    def _split_kind(cls, kind: str | None) -> list[str] | None:
+        if kind is not None:
+            return kind.split(',')
+
+
+class SearchResultSchema(BaseModel):
+    kind: Literal['airport', 'city', 'company']
+    code: str
+    name: str | None
+    name_ru: str | None
+    score: float
 
 
 class ChangelogSchema(BaseModel):
@@ -82,6 +206,10 @@ class AircraftPagedResponseSchema(PagedResponseSchema):
     items: list[AircraftResponseSchema]
 
 
+class AircraftFieldsetSchema(FieldsetSchema):
+    item_schema = AircraftResponseSchema
+
+
 class AircraftQuerySchema(BaseSchema):
     name: str | None = QueryField(None, serialization_alias='ilike::name')
 
@@ -115,6 +243,10 @@ class CitySchema(BaseSchema):
     country: CountrySchema
 
 
+class CountryFieldsetSchema(FieldsetSchema):
+    item_schema = CountryResponseSchema
+
+
 class CountryQuerySchema(BaseSchema):
     region: str | None = QueryField(None, serialization_alias='ilike::region')
 
@@ -140,6 +272,10 @@ class CityPagedResponseSchema(PagedResponseSchema):
     items: list[CityResponseSchema]
 
 
+class CityFieldsetSchema(FieldsetSchema):
+    item_schema = CityResponseSchema
+
+
 class CityQuerySchema(BaseSchema):
     timezone: str | None = QueryField(None, serialization_alias='ilike::timezone')
     region: str | None = QueryField(None, serialization_alias='ilike::CountryModel^region')
@@ -180,16 +316,21 @@ class AirportPagedResponseSchema(PagedResponseSchema):
     items: list[AirportResponseSchema]
 
 
+class AirportFieldsetSchema(FieldsetSchema):
+    item_schema = AirportResponseSchema
+
+
 class AirportQuerySchema(BaseSchema):
     city: str | None = QueryField(None, serialization_alias='ilike::CityModel^name.name_ru')
     timezone: str | None = QueryField(None, serialization_alias='ilike::CityModel^timezone')
     country: str | None = QueryField(None, serialization_alias='ilike::CityModel^CountryModel^name')
     region: str | None = QueryField(None, serialization_alias='ilike::CityModel^CountryModel^region')
     name: str | None = QueryField(None, serialization_alias='ilike::name.name_ru')
-    date_start: AwareDatetime | None = QueryField(None, serialization_alias='ge@FlightModel^mar1_iata~mar2_iata~sked_local')
-    date_end: AwareDatetime | None = QueryField(None, serialization_alias='le@FlightModel^mar1_iata~mar2_iata~sked_local')
-    company : str | None = QueryField(None, serialization_alias='eq@FlightModel^mar1_iata~mar2_iata~company_iata', pattern=patterns.company_iata)
-    direction: Direction | None = QueryField(None, serialization_alias='eq@FlightModel^mar1_iata~mar2_iata~direction')
+    # flights of the airport as mar1 or mar2, answered by the flight_stats aggregate
+    date_start: AwareDatetime | None = None
+    date_end: AwareDatetime | None = None
+    company: str | None = QueryField(None, pattern=patterns.company_iata)
+    direction: Direction | None = None
 
     @field_validator('city', 'country', 'region', 'name', 'timezone', mode='after')
     @classmethod
@@ -224,10 +365,11 @@ class CompanyResponseSchema(CompanySchema):
 
 class CompanyQuerySchema(BaseSchema):
     name: str | None = QueryField(None, serialization_alias='ilike::name')
-    date_start: AwareDatetime | None = QueryField(None, serialization_alias='ge@FlightModel^sked_local')
-    date_end: AwareDatetime | None = QueryField(None, serialization_alias='le@FlightModel^sked_local')
-    airport: str | None = QueryField(None, serialization_alias='eq@FlightModel^mar1_iata.mar2_iata', pattern=patterns.airport_iata)
-    direction: Direction | None = QueryField(None, serialization_alias='eq@FlightModel^direction')
+    # flights of the company, answered by the flight_stats aggregate
+    date_start: AwareDatetime | None = None
+    date_end: AwareDatetime | None = None
+    airport: str | None = QueryField(None, pattern=patterns.airport_iata)
+    direction: Direction | None = None
 
     @field_validator('name', mode='after')
     @classmethod
@@ -249,6 +391,10 @@ class CompanyPagedResponseSchema(PagedResponseSchema):
     items: list[CompanyResponseSchema]
 
 
+class CompanyFieldsetSchema(FieldsetSchema):
+    item_schema = CompanyResponseSchema
+
+
 class FlightSchema(BaseSchema):
     orig_id: int = Field(validation_alias=AliasChoices('orig_id', 'id'))
     company: CompanySchema
@@ -329,6 +475,40 @@ class FlightPagedResponseSchema(PagedResponseSchema):
     items: list[FlightResponseSchema]
 
 
+class FlightCursorPagedResponseSchema(CursorPagedResponseSchema):
+    items: list[FlightResponseSchema]
+
+
+class FlightSideloadedResponseSchema(FlightResponseSchema):
+    company: str
+    mar1: str | None = None
+    mar2: str | None = None
+    mar3: str | None = None
+    mar4: str | None = None
+    mar5: str | None = None
+    aircraft: str | None
+
+
+class IncludedSchema(BaseSchema):
+    airports: dict[str, AirportResponseSchema]
+    companies: dict[str, CompanyResponseSchema]
+    aircrafts: dict[str, AircraftResponseSchema]
+
+
+class FlightSideloadedPagedResponseSchema(PagedResponseSchema):
+    items: list[FlightSideloadedResponseSchema]
+    included: IncludedSchema
+
+
+class FlightSideloadedCursorPagedResponseSchema(CursorPagedResponseSchema):
+    items: list[FlightSideloadedResponseSchema]
+    included: IncludedSchema
+
+
+class FlightFieldsetSchema(FieldsetSchema):
+    item_schema = FlightResponseSchema
+
+
 class FlightQuerySchema(BaseSchema):
     date_start: AwareDatetime = QueryField(serialization_alias='ge@sked_local')
     date_end: AwareDatetime = QueryField(serialization_alias='le@sked_local')
@@ -356,3 +536,36 @@ class FlightQuerySchema(BaseSchema):
     def validate_model(self):
         check_timedelta(self)
         return self
+
+
+class FlightExportQuerySchema(FlightQuerySchema):
+
+    @model_validator(mode='after')
+    def validate_model(self):
+        return self
+
+
+class DelaysQuerySchema(BaseModel):
+    group_by: Literal['company', 'destination', 'hour', 'day'] = 'company'
+    actual: Literal['at_local', 'otpr', 'takeoff_et'] = Field('at_local', description='time the delay is measured at, against sked_local')
+    on_time: int = Field(15, ge=0, le=180, description='minutes of delay still counted as on time')
+    timezone: str = Field('UTC', description='IANA timezone of hour and day groups')
+
+    @field_validator('timezone', mode='after')
+    @classmethod
+    def _check_timezone(cls, name: str) -> str:
+        try:
+            ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'Unknown timezone: {name}')
+        return name
+
+
+class DelayStatsSchema(BaseModel):
+    key: str | int | date | None = Field(description='company or destination iata, hour of day or day')
+    count: int
+    mean: float | None = Field(description='minutes, negative ones are early')
+    p50: float | None
+    p90: float | None
+    p99: float | None
+    on_time_share: float | None
@@ -0,0 +1,152 @@
+import json
+import math
+from collections import namedtuple
+from functools import lru_cache
+from types import NoneType, UnionType
+from typing import Any, Union, get_args, get_origin
+
+import orjson
+from fastapi import Response
+from pydantic import BaseModel, TypeAdapter
+from sqlalchemy import DateTime, Float, cast, func, inspect, literal, literal_column, select
+from sqlalchemy.sql.expression import ColumnElement
+
+from ..config import settings
+from ..models import Base
+
+
+FieldPlan = namedtuple('FieldPlan', field_names=['key', 'attr', 'convert', 'plan', 'many', 'mapping'])
+
+
+class Raw(str):
+    """ JSON serialized elsewhere, e.g. by the database, rendered as is."""
+
+
+class Fallback(Exception):
+    """ Value orjson would not render byte-identical to the standard encoder."""
+
+
+def _float(value) -> float:
+    value = float(value)
+    # json.dumps writes 1e-05 and 1e+16 where orjson writes 1e-5 and 1e16, allow_nan=False rejects the rest
+    if not math.isfinite(value) or (value and not 1e-4 <= abs(value) < 1e16):
+        raise Fallback
+    return value
+
+
+def _unwrap(annotation):
+    if get_origin(annotation) in (Union, UnionType):
+        args = [arg for arg in get_args(annotation) if arg is not NoneType]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+
+@lru_cache(maxsize=256)
+def field_plan(schema: type[BaseModel]) -> tuple[FieldPlan, ...]:
+    """ Output key, source attribute and conversion of every field, resolved once per schema."""
+    plan = []
+    for name, field in schema.model_fields.items():
+        annotation = _unwrap(field.annotation)
+        many = get_origin(annotation) is list
+        mapping = get_origin(annotation) is dict
+        if many or mapping:
+            annotation = _unwrap(get_args(annotation)[-1] if get_args(annotation) else Any)
+
+        nested = field_plan(annotation) if isinstance(annotation, type) and issubclass(annotation, BaseModel) else None
+        plan.append(FieldPlan(
+            key=field.serialization_alias or field.alias or name,
+            attr=name,
+            convert=_float if annotation is float else None,
+            plan=nested,
+            many=many,
+            mapping=mapping,
+        ))
+    return tuple(plan)
+
+
+def build(obj: Any, plan: tuple[FieldPlan, ...]) -> dict:
+    """ Plain dict of an ORM model, a dict or a schema instance, values are trusted and not validated."""
+    # loaded ORM attributes and pydantic fields both live in __dict__, unloaded ones go through the descriptor
+    values = obj if isinstance(obj, dict) else obj.__dict__
+    result = {}
+    for field in plan:
+        value = values[field.attr] if field.attr in values else getattr(obj, field.attr, None)
+        if value is not None:
+            if field.plan is not None and field.many:
+                value = [build(item, field.plan) for item in value]
+            elif field.plan is not None and field.mapping:
+                value = {key: build(item, field.plan) for key, item in value.items()}
+            elif field.plan is not None:
+                value = build(value, field.plan)
+            elif field.convert is not None:
+                value = field.convert(value)
+        result[field.key] = value
+    return result
+
+
+def _timestamp(value: ColumnElement) -> ColumnElement:
+    """ timestamptz as pydantic writes it, in UTC with Z and the fraction only when there is one."""
+    utc = func.to_char(func.timezone('UTC', value), 'YYYY-MM-DD"T"HH24:MI:SS.US')
+    return func.replace(utc, '.000000', '').concat(literal('Z'))
+
+
+@lru_cache(maxsize=256)
+def json_object(model: type[Base], plan: tuple[FieldPlan, ...]) -> ColumnElement:
+    """ json_build_object over a row of model with the keys of plan, to render it in the database.
+    Timestamps are written in UTC, as the python path does over a UTC database session.
+    Nested objects are correlated subqueries over the relationships, collections render empty like noload ones.
+    """
+    relationships = inspect(model).relationships
+    pairs = []
+    for field in plan:
+        if field.plan is not None and (field.many or field.mapping):
+            value = func.json_build_array() if field.many else func.json_build_object()
+        elif field.plan is not None:
+            relation = relationships[field.attr]
+            value = select(json_object(relation.mapper.class_, field.plan)).where(relation.primaryjoin).scalar_subquery()
+        else:
+            value = getattr(model, field.attr)
+            if field.convert is _float:
+                value = cast(value, Float)      # numeric renders its scale, 55.500000
+            elif isinstance(value.type, DateTime) and value.type.timezone:
+                value = _timestamp(value)       # json_build_object writes +00:00
+        pairs.extend((literal_column(f"'{field.key}'"), value))
+    return func.json_build_object(*pairs)
+
+
+@lru_cache(maxsize=256)
+def _adapter(schema: Any) -> TypeAdapter:
+    return TypeAdapter(schema)
+
+
+def _render_raw(content: dict) -> bytes:
+    parts = (
+        orjson.dumps(key) + b':' + (value.encode() if isinstance(value, Raw) else orjson.dumps(value, option=orjson.OPT_UTC_Z))
+        for key, value in content.items()
+    )
+    return b'{' + b','.join(parts) + b'}'
+
+
+def render(schema: Any, content: Any) -> bytes:
+    """ Same bytes as FastAPI's response_model validation followed by JSONResponse.
+    Raw content and dicts with Raw values, as pages rendered by the database, are passed through.
+    """
+    if isinstance(content, Raw):
+        return content.encode()
+    if isinstance(content, dict) and any(isinstance(value, Raw) for value in content.values()):
+        return _render_raw(content)
+
+    if settings.FAST_SERIALIZATION and isinstance(schema, type) and issubclass(schema, BaseModel):
+        try:
+            return orjson.dumps(build(content, field_plan(schema)), option=orjson.OPT_UTC_Z)
+        except (Fallback, orjson.JSONEncodeError):
+            pass
+
+    adapter = _adapter(schema)
+    data = adapter.dump_python(adapter.validate_python(content, from_attributes=True), mode='json', by_alias=True)
+    return json.dumps(data, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')).encode('utf-8')
+
+
+def json_response(schema: Any, content: Any, headers: dict | None = None) -> Response:
+    return Response(content=render(schema, content), media_type='application/json', headers=headers)
@@ -1,39 +1,99 @@
+import csv
+import io
 import math
-from typing import Any, Collection, TypeVar
+from collections import namedtuple
+from datetime import datetime
+from typing import Any, AsyncIterator, Collection, Literal, Sequence, TypeVar
 
+from pydantic import ValidationError
+from sqlalchemy import inspect
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from . import (
+    caches,
+    models,
     repositories,
     schemas,
+    serializers,
+    utils,
 )
+from ..config import settings
+from ..database import async_session
+
+
+Reference = namedtuple('Reference', field_names=['key', 'service', 'included'])
 
 
 class Service:
     repo = TypeVar('repo', bound=repositories.Repository)
+    query_schema: type[schemas.BaseSchema] | None = None
+    cached: bool = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.query_schema is not None:
+            cls.repo.compile_filters(cls.query_schema)
 
     @classmethod
-    async def upsert_many(cls, session: AsyncSession, data: Collection[schemas.BaseSchema]) -> None:
-        changelog = await cls.repo.upsert_many(session, [d.model_dump(by_alias=True) for d in data])
+    async def upsert_many(cls, session: AsyncSession, data: Collection[schemas.BaseSchema]) -> Sequence[repositories.Change]:
+        return await cls.repo.upsert_many(session, [d.model_dump(by_alias=True) for d in data])
 
     @classmethod
     async def get_one(cls, session: AsyncSession, id: Any, join_relations: tuple | None = None):
+        if cls.cached and not join_relations:
+            if (entity := await caches.references.get(cls.repo.model, id)) is not None:
+                return entity
         return await cls.repo.get_one(session, id=id, join_relations=join_relations)
 
     @classmethod
     async def get_many(cls, session: AsyncSession, paging: schemas.PagingSchema, **params) -> dict:
-        ids = await cls.repo.get_many_ids(session, **params)
-        paged_ids = paging.get_page(ids)
-        models = await cls.repo.get_many(session, ids=paged_ids, **params)
+        if isinstance(paging, schemas.CursorPagingSchema) and paging.cursor is not None:
+            return await cls.get_many_keyset(session, paging=paging, **params)
+
+        models, total = await cls.repo.get_page(
+            session,
+            limit=paging.limit,
+            offset=paging.offset,
+            count=paging.count,
+            **params
+        )
 
         return dict(
             items=models,
             count=len(models),
-            total=len(ids),
+            total=total,
             page=paging.page,
-            total_pages=math.ceil(len(ids) / paging.limit),
+            total_pages=math.ceil(total / paging.limit) if total is not None else None,
+        )
+
+    @classmethod
+    async def get_many_keyset(cls, session: AsyncSession, paging: schemas.CursorPagingSchema, **params) -> dict:
+        cursor = paging.cursor
+        models = await cls.repo.get_many_keyset(session, cursor=cursor, limit=paging.limit, **params)
+
+        has_more = len(models) > paging.limit
+        models = models[:paging.limit]
+        if cursor.direction == 'prev':
+            models = models[::-1]
+            has_next, has_prev = True, has_more
+        else:
+            has_next, has_prev = has_more, cursor.values is not None
+
+        order_by = params.get('order_by')
+        return dict(
+            items=models,
+            count=len(models),
+            next=utils.encode_cursor('next', cls.repo.keyset_values(models[-1], order_by)) if models and has_next else None,
+            prev=utils.encode_cursor('prev', cls.repo.keyset_values(models[0], order_by)) if models and has_prev else None,
         )
 
+    @classmethod
+    async def validator(cls, session: AsyncSession, id: Any | None = None, **params) -> repositories.Validator:
+        validator = await cls.repo.validator(session, id=id, **params)
+        # bodies taken from the reference cache must not be older than the validator sent with them
+        await caches.references.catch_up(validator.last_modified if cls.cached else validator.references_modified)
+        return validator
+
     @classmethod
     async def get_many_by_ids(cls, session: AsyncSession, ids: list, **params) -> list:
         models = await cls.repo.get_many(session, ids=ids, **params)
@@ -43,39 +103,182 @@ class Service:
 
 class AircraftService(Service):
     repo = repositories.AircraftRepository()
+    query_schema = schemas.AircraftQuerySchema
+    cached = True
 
 
 class CountryService(Service):
     repo = repositories.CountryRepository()
+    query_schema = schemas.CountryQuerySchema
+    cached = True
 
 
 class CompanyService(Service):
     repo = repositories.CompanyRepository()
+    query_schema = schemas.CompanyQuerySchema
+    cached = True
 
 
 class CityService(Service):
     repo = repositories.CityRepository()
+    query_schema = schemas.CityQuerySchema
+    cached = True
 
     @classmethod
-    async def upsert_many(cls, session: AsyncSession, data: Collection[schemas.CityDBSchema]) -> None:
+    async def upsert_many(cls, session: AsyncSession, data: Collection[schemas.CityDBSchema]) -> Sequence[repositories.Change]:
         await CountryService.upsert_many(session, [city.country for city in data])
-        await cls.repo.upsert_many(session, [city.model_dump(by_alias=True) for city in data])
+        return await cls.repo.upsert_many(session, [city.model_dump(by_alias=True) for city in data])
 
 
 class AirportService(Service):
     repo = repositories.AirportRepository()
+    query_schema = schemas.AirportQuerySchema
+    cached = True
 
     @classmethod
-    async def upsert_many(cls, session: AsyncSession, data: Collection[schemas.AirportDBSchema]) -> None:
+    async def upsert_many(cls, session: AsyncSession, data: Collection[schemas.AirportDBSchema]) -> Sequence[repositories.Change]:
         await CityService.upsert_many(session, [airport.city for airport in data])
-        await cls.repo.upsert_many(session, [airport.model_dump(by_alias=True) for airport in data])
+        return await cls.repo.upsert_many(session, [airport.model_dump(by_alias=True) for airport in data])
+
+
+class SearchService:
+    repo = repositories.SearchRepository()
+
+    @classmethod
+    async def validator(cls, session: AsyncSession) -> repositories.Validator:
+        return await cls.repo.validator(session)
+
+    @classmethod
+    async def search(cls, session: AsyncSession, params: schemas.SearchQuerySchema) -> Sequence:
+        return await cls.repo.search(session, params.q, limit=params.limit, kinds=params.kind)
 
 
 class FlightService(Service):
     repo = repositories.FlightRepository()
+    query_schema = schemas.FlightQuerySchema
+    # relation -> foreign key column, service of the referenced entity and its key in sideloaded `included`
+    references = dict(
+        company=Reference(key='company_iata', service=CompanyService, included='companies'),
+        aircraft=Reference(key='aircraft_name', service=AircraftService, included='aircrafts'),
+        **{f'mar{n}': Reference(key=f'mar{n}_iata', service=AirportService, included='airports') for n in range(1, 6)},
+    )
+    _columns = tuple(utils.get_columns(models.FlightModel, exclude={'content_hash'}, include_primary=True))
+
+    @classmethod
+    async def get_one(cls, session: AsyncSession, id: Any, join_relations: tuple | None = None):
+        flight = await cls.repo.get_one(session, id=id, join_relations=join_relations, exclude=cls._excluded_relations())
+        return (await cls._hydrate(session, [flight]))[0] if flight is not None else None
+
+    @classmethod
+    async def get_many(cls, session: AsyncSession, paging: schemas.PagingSchema, fields: frozenset | None = None, **params) -> dict:
+        if settings.FLIGHT_RENDERING == 'database' and not cls.repo.reads_archive(params):
+            page = await super().get_many(session, paging, render=cls._json_object(fields), **params)
+            page['items'] = serializers.Raw('[' + ','.join(row.json for row in page['items']) + ']')
+            return page
+
+        page = await super().get_many(session, paging, exclude=set(cls._excluded_relations()), fields=fields, **params)
+        page['items'] = await cls._hydrate(session, page['items'], fields)
+        return page
+
+    @classmethod
+    async def get_many_by_ids(cls, session: AsyncSession, ids: list, **params) -> list | serializers.Raw:
+        if settings.FLIGHT_RENDERING == 'database':
+            rows = await super().get_many_by_ids(session, ids, render=cls._json_object(), **params)
+            archived = cls.repo.archive.get_many([id for id, row in zip(ids, rows) if not row])
+            rendered = {
+                id: serializers.render(schemas.FlightResponseSchema, item).decode()
+                for id, item in zip(archived, await cls._hydrate(session, list(archived.values())))
+            }
+            return serializers.Raw('[' + ','.join(row.json if row else rendered.get(id, '{}') for id, row in zip(ids, rows)) + ']')
+
+        flights = await super().get_many_by_ids(session, ids, exclude=set(cls._excluded_relations()), **params)
+        hydrated = iter(await cls._hydrate(session, [flight for flight in flights if flight]))
+        return [next(hydrated) if flight else flight for flight in flights]
+
+    @classmethod
+    async def get_many_sideloaded(cls, session: AsyncSession, paging: schemas.PagingSchema, fields: frozenset | None = None, **params) -> dict:
+        """ Page of flights referencing companies, aircrafts and airports by code, each of them included once."""
+        page = await super().get_many(session, paging, exclude=set(cls.references), fields=fields, **params)
+        flights = page['items']
+        columns, relations = cls._selected(fields)
+        references = await cls._references(session, flights, relations)
+
+        page['items'] = [
+            cls._item(flight, columns, **{relation: getattr(flight, cls.references[relation].key) for relation in relations})
+            for flight in flights
+        ]
+        included = dict(airports={}, companies={}, aircrafts={})
+        for relation in relations:
+            reference = cls.references[relation]
+            for flight in flights:
+                if (code := getattr(flight, reference.key)) in references[relation]:
+                    included[reference.included][code] = references[relation][code]
+        page['included'] = included
+        return page
+
+    @classmethod
+    def _json_object(cls, fields: frozenset | None = None):
+        """ Response item built by PostgreSQL, relations included."""
+        schema = schemas.trimmed(schemas.FlightResponseSchema, fields)
+        return serializers.json_object(cls.repo.model, serializers.field_plan(schema))
 
     @classmethod
-    async def upsert_many(cls, session: AsyncSession, data: Collection[schemas.FlightDBSchema]) -> None:
+    def _excluded_relations(cls) -> tuple:
+        return tuple(cls.references) if settings.FLIGHT_RELATIONS_LOADING != 'joined' else ()
+
+    @classmethod
+    def _selected(cls, fields: frozenset | None) -> tuple[tuple, tuple]:
+        """ Columns and reference relations among the requested fields, all of them by default."""
+        if fields is None:
+            return cls._columns, tuple(cls.references)
+        return tuple(name for name in cls._columns if name in fields), tuple(name for name in cls.references if name in fields)
+
+    @classmethod
+    async def _references(cls, session: AsyncSession, flights: Sequence[models.FlightModel], relations: Sequence[str]) -> dict[str, dict]:
+        """ Entities of every relation by code, from the reference cache or from one query per entity for the whole page."""
+        keys = {}
+        for relation in relations:
+            reference = cls.references[relation]
+            keys.setdefault(reference.service, set()).update(
+                code for flight in flights if (code := getattr(flight, reference.key)) is not None
+            )
+
+        if settings.FLIGHT_RELATIONS_LOADING == 'cache':
+            entities = {
+                service: await caches.references.get_many(service.repo.model, service_keys) for service, service_keys in keys.items()
+            }
+        else:
+            entities = {
+                service: {getattr(model, service.repo.unique_key): model for model in await service.repo.get_many(session, ids=list(service_keys))}
+                for service, service_keys in keys.items()
+            }
+        return {relation: entities[cls.references[relation].service] for relation in relations}
+
+    @classmethod
+    async def _hydrate(cls, session: AsyncSession, flights: Sequence[models.FlightModel], fields: frozenset | None = None) -> list:
+        """ Flights as dicts with companies, aircrafts and airports taken from the reference cache
+        or from one query per entity for the whole page, joined flights are returned as is, archived ones never are.
+        """
+        if not flights or settings.FLIGHT_RELATIONS_LOADING == 'joined' and not any(inspect(flight).transient for flight in flights):
+            return list(flights)
+
+        columns, relations = cls._selected(fields)
+        references = await cls._references(session, flights, relations)
+        return [
+            cls._item(
+                flight,
+                columns,
+                **{relation: references[relation].get(getattr(flight, cls.references[relation].key)) for relation in relations},
+            )
+            for flight in flights
+        ]
+
+    @staticmethod
+    def _item(flight: models.FlightModel, columns: Sequence[str], **relations) -> dict:
+        return dict({name: getattr(flight, name) for name in columns}, changelog=flight.changelog, **relations)
+
+    @classmethod
+    async def upsert_many(cls, session: AsyncSession, data: Collection[schemas.FlightDBSchema]) -> Sequence[repositories.Change]:
         companies, aircrafts, airports = set(), set(), set()
         for flight in data:
             companies.add(flight.company)
@@ -84,8 +287,102 @@ class FlightService(Service):
                 if (airport := getattr(flight, f'mar{n}')) is not None:
                     airports.add(airport)
 
-        await AircraftService.upsert_many(session, aircrafts)
-        await CompanyService.upsert_many(session, companies)
-        await AirportService.upsert_many(session, airports)
+        # this data rarely changes, entities confirmed by a recent push of this worker are left out
+        for service, entities in ((AircraftService, aircrafts), (CompanyService, companies), (AirportService, airports)):
+            model, key = service.repo.model, service.repo.unique_key
+            if unconfirmed := caches.confirmed.unconfirmed(model, key, entities):
+                await service.upsert_many(session, unconfirmed)
+                caches.confirmed.confirm_on_commit(session, model, key, unconfirmed)
+
+        return await cls.repo.upsert_many(session, [flight.model_dump(by_alias=True) for flight in data])
+
+    @classmethod
+    async def upsert_ndjson(cls, session: AsyncSession, lines: AsyncIterator[bytes], chunk_size: int) -> list[dict]:
+        """ Validates records as they arrive and upserts them in chunks of chunk_size received lines."""
+        results, flights, errors = [], [], []
+
+        line_no = 0
+        async for line in lines:
+            line_no += 1
+            if not line.strip():
+                continue
+
+            try:
+                flights.append(schemas.FlightDBSchema.model_validate_json(line))
+            except ValidationError as err:
+                errors.append(dict(line=line_no, detail=err.errors(include_url=False, include_context=False, include_input=False)))
+
+            if len(flights) + len(errors) >= chunk_size:
+                results.append(await cls._upsert_chunk(session, len(results), flights, errors))
+                flights, errors = [], []
+
+        if flights or errors:
+            results.append(await cls._upsert_chunk(session, len(results), flights, errors))
+
+        return results
+
+    @classmethod
+    async def _upsert_chunk(cls, session: AsyncSession, index: int, flights: list, errors: list) -> dict:
+        changelog = await cls.upsert_many(session, flights) if flights else []
+        await session.flush()
+        session.expunge_all()     # keep the identity map bounded by the chunk size
+
+        return dict(
+            chunk=index,
+            received=len(flights) + len(errors),
+            upserted=len(flights),
+            changed=len(changelog),
+            errors=errors,
+        )
+
+    @classmethod
+    async def export(cls, fmt: Literal['ndjson', 'csv'], batch_size: int = 500, **params) -> AsyncIterator[str]:
+        """ Yields serialized batches of flights. Opens its own session because it outlives the request dependencies."""
+        columns = list(cls._columns)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        if fmt == 'csv':
+            writer.writerow(columns)
+
+        async with async_session() as session:
+            n = 0
+            async for flight in cls.repo.stream_many(session, yield_per=batch_size, **params):
+                if fmt == 'csv':
+                    writer.writerow(_csv_value(getattr(flight, column)) for column in columns)
+                else:
+                    buffer.write(schemas.FlightResponseSchema.model_validate(flight).model_dump_json())
+                    buffer.write('\n')
+
+                n += 1
+                if n % batch_size == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+
+        yield buffer.getvalue()
+
+    @classmethod
+    async def delays(cls, session: AsyncSession, params: schemas.DelaysQuerySchema, **filters) -> list[dict]:
+        rows = await cls.repo.delays(
+            session, group_by=params.group_by, actual=params.actual, on_time=params.on_time, tz=params.timezone, **filters
+        )
+        return [
+            dict(
+                key=key,
+                count=count,
+                mean=_round(mean),
+                **dict(zip(('p50', 'p90', 'p99'), map(_round, percentiles))),
+                on_time_share=_round(on_time_share, 4),
+            )
+            for key, count, mean, percentiles, on_time_share in rows
+        ]
+
+
+def _csv_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
 
-        await cls.repo.upsert_many(session, [flight.model_dump(by_alias=True) for flight in data])
+def _round(value: float | None, digits: int = 1) -> float | None:
+    return round(value, digits) if value is not None else None
@@ -1,9 +1,22 @@
-from datetime import timedelta
-from typing import Iterable, Optional, Type
+import base64
+import binascii
+import hashlib
+import json
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, Optional, Type, Literal, Sequence
 
-from fastapi import HTTPException, status
+import orjson
+from fastapi import HTTPException, Request, Response, status
 from sqlalchemy.orm import DeclarativeBase
 
+from . import errors
+
+
+Cursor = namedtuple('Cursor', field_names=['direction', 'values'])
+
 
 def get_columns(model: Type[DeclarativeBase], exclude: Optional[Iterable] = tuple(), include_primary: bool = False):
     columns = dict(model.__table__.columns.items())
@@ -18,6 +31,68 @@ def get_columns(model: Type[DeclarativeBase], exclude: Optional[Iterable] = tupl
     return columns
 
 
+def content_hash(record: dict) -> str:
+    """ Digest of a record as dumped by its schema, regardless of the key order."""
+    return hashlib.blake2b(orjson.dumps(record, option=orjson.OPT_SORT_KEYS, default=str), digest_size=16).hexdigest()
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def iter_lines(stream: AsyncIterable[bytes],
+                     compressed: bool = False,
+                     inflate_size: int = 2 ** 16,
+                     max_line: int = 2 ** 20,
+                     ) -> AsyncIterator[bytes]:
+    """ Split a (gzip-compressed) byte stream into lines without buffering the whole body.
+    A line longer than max_line bytes is an invalid body, so is a partial one growing past it.
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16) if compressed else None
+    tail = b''
+
+    async for data in stream:
+        if decompressor is None:
+            blocks = (data,)
+        else:
+            blocks = _inflate(decompressor, data, inflate_size)
+
+        for block in blocks:
+            *lines, tail = (tail + block).split(b'\n')
+            if len(tail) > max_line or any(len(line) > max_line for line in lines):
+                raise errors.INVALID_BODY
+            for line in lines:
+                yield line
+
+    if decompressor is not None:
+        *lines, tail = (tail + decompressor.flush()).split(b'\n')
+        if len(tail) > max_line or any(len(line) > max_line for line in lines):
+            raise errors.INVALID_BODY
+        for line in lines:
+            yield line
+        if not decompressor.eof:
+            raise errors.INVALID_BODY
+
+    if tail:
+        yield tail
+
+
+def _inflate(decompressor, data: bytes, size: int) -> Iterator[bytes]:
+    try:
+        while data:
+            yield decompressor.decompress(data, size)
+            data = decompressor.unconsumed_tail
+    except zlib.error:
+        raise errors.INVALID_BODY
+
+
 def check_timedelta(self):
     """ Use as model_validator wrapped method for query schemas."""
     max_days = 7 #todo move to .env
@@ -37,3 +112,55 @@ def check_timedelta(self):
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail=f'Difference between start date and end date must be less then {max_days} days, current is {delta.days} days'
                 )
+
+
+def encode_cursor(direction: Literal['next', 'prev'], values: Sequence) -> str:
+    """ Pack keyset position into an opaque url-safe token."""
+    payload = json.dumps(
+        [direction, *(v.isoformat() if isinstance(v, datetime) else v for v in values)],
+        separators=(',', ':'),
+    )
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token: str) -> Cursor:
+    """ Use as field_validator wrapped method for cursor fields. Empty token means the first page."""
+    if not token:
+        return Cursor(direction='next', values=None)
+
+    try:
+        direction, *values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise errors.INVALID_CURSOR
+
+    if direction not in ('next', 'prev') or not values:
+        raise errors.INVALID_CURSOR
+
+    return Cursor(direction=direction, values=tuple(values))
+
+
+def check_not_modified(request: Request, response: Response, validator: tuple[int, datetime | None, ...]) -> dict:
+    """ Sets ETag and Last-Modified, raises 304 when the client copy is still valid."""
+    count, last_modified, *_ = validator
+    query = '&'.join(sorted(f'{k}={v}' for k, v in request.query_params.multi_items()))
+    digest = hashlib.sha1(f'{request.url.path}?{query}|{count}|{last_modified}'.encode()).hexdigest()
+    headers = {'ETag': f'W/"{digest}"', 'Cache-Control': 'no-cache'}
+    if last_modified is not None:
+        last_modified = last_modified.astimezone(timezone.utc).replace(microsecond=0)
+        headers['Last-Modified'] = format_datetime(last_modified, usegmt=True)
+
+    if (if_none_match := request.headers.get('if-none-match')) is not None:
+        tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        not_modified = '*' in tags or headers['ETag'].removeprefix('W/') in tags
+    elif (if_modified_since := request.headers.get('if-modified-since')) is not None and last_modified is not None:
+        try:
+            not_modified = last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            not_modified = False
+    else:
+        not_modified = False
+
+    if not_modified:
+        raise HTTPException(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return headers
@@ -1,16 +1,34 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.gzip import GZipMiddleware
 
 from .config import settings
 from .routes import api_router
 from .middleware import log_requests
+from .response_cache import ResponseCacheMiddleware
+from .flights_api import caches, ingestion, partitions
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    await caches.references.load()
+    tasks = [asyncio.create_task(partitions.maintenance_loop())]
+    if settings.FLIGHT_INGESTION == 'queue':
+        tasks.append(asyncio.create_task(ingestion.consumer_loop()))
+    yield
+    for task in tasks:
+        task.cancel()
 
 
 app = FastAPI(
     root_path=settings.ROOT_PATH,
     title='SvologAPI',
     version='0.1.0',
+    lifespan=lifespan,
 )
+app.add_middleware(ResponseCacheMiddleware)
 app.add_middleware(GZipMiddleware, minimum_size=500)
 app.middleware('http')(log_requests)
 
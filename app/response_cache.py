@@ -0,0 +1,353 @@
+import asyncio
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+from collections import OrderedDict, namedtuple
+from email.utils import parsedate_to_datetime
+from typing import Any, Iterable
+from urllib.parse import parse_qsl
+
+from anyio import to_thread
+from fastapi.dependencies.models import Dependant
+from fastapi.dependencies.utils import get_flat_dependant
+from fastapi.routing import APIRoute
+from fastapi.responses import StreamingResponse
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from starlette.datastructures import Headers
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .config import settings
+
+
+Entry = namedtuple('Entry', field_names=['status', 'headers', 'body', 'stored_at'])
+
+
+class MemoryBackend:
+    """ Per-worker LRU of at most size entries."""
+    blocking = False
+
+    def __init__(self, size: int):
+        self.size = size
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._generations: dict[str, int] = {}
+
+    def generation(self, namespace: str) -> int:
+        return self._generations.get(namespace, 0)
+
+    def bump(self, namespace: str) -> None:
+        self._generations[namespace] = time.time_ns()
+
+    def get(self, key: str) -> Any | None:
+        if (item := self._data.get(key)) is None:
+            return None
+        expires, value = item
+        if expires < time.time():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        self._data[key] = (time.time() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._generations.clear()
+
+
+class FileBackend:
+    """ Entries pickled into a directory shared by the workers of one host.
+    A file is named by the namespace and generation its key starts with and its mtime is set to the expiry,
+    prune removes expired files and those of replaced generations every prune_interval seconds.
+    """
+    blocking = True
+    prune_interval = 60
+
+    def __init__(self, path: str):
+        self.path = path
+        self._pruned_at = time.time()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key: str) -> str:
+        namespace, generation, _ = key.split(':', 2)
+        return os.path.join(self.path, f'{namespace}-{generation}-{hashlib.sha1(key.encode()).hexdigest()}')
+
+    def generation(self, namespace: str) -> int:
+        try:
+            with open(os.path.join(self.path, f'generation-{namespace}')) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def bump(self, namespace: str) -> None:
+        self._write(os.path.join(self.path, f'generation-{namespace}'), str(time.time_ns()).encode())
+
+    def _write(self, path: str, data: bytes, expires: float | None = None) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if expires is not None:
+            os.utime(tmp, (expires, expires))
+        os.replace(tmp, path)      # readers never see a partial file
+
+    @staticmethod
+    def _unlink(path: str) -> None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:   # removed by another worker
+            pass
+
+    def get(self, key: str) -> Any | None:
+        path = self._file(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires < time.time():
+            self._unlink(path)
+            return None
+        return value
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        expires = time.time() + ttl
+        self._write(self._file(key), pickle.dumps((expires, value)), expires)
+        if time.time() - self._pruned_at >= self.prune_interval:
+            self.prune()
+
+    def prune(self) -> None:
+        now, generations = time.time(), {}
+        self._pruned_at = now
+        for entry in os.scandir(self.path):
+            parts = entry.name.split('-', 2)
+            if len(parts) != 3 or parts[0] == 'generation':
+                continue
+            namespace, generation, _ = parts
+            if namespace not in generations:
+                generations[namespace] = str(self.generation(namespace))
+            try:
+                expired = entry.stat().st_mtime < now
+            except FileNotFoundError:
+                continue
+            if expired or generation != generations[namespace]:
+                self._unlink(entry.path)
+
+    def clear(self) -> None:
+        for name in os.listdir(self.path):
+            os.unlink(os.path.join(self.path, name))
+
+
+class ResponseCache:
+    """ Caches 200 responses of GET routes by route and normalized query, grouped into namespaces by route tag.
+    A namespace is invalidated by replacing its generation, which is a part of every key.
+    """
+    # namespace -> namespaces whose responses embed or filter by it
+    dependants = {
+        'aircrafts': {'flights'},
+        'countries': {'cities', 'airports', 'flights'},
+        'cities': {'airports', 'flights', 'search'},
+        'airports': {'flights', 'search'},
+        'companies': {'flights', 'search'},
+        'flights': {'airports', 'companies'},
+    }
+    namespaces = {*dependants, 'search'}
+
+    def __init__(self, backend: MemoryBackend | FileBackend, ttl: float, stale_while_revalidate: float, stale_if_error: float):
+        self.backend = backend
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+
+    async def _call(self, method: str, *args):
+        if self.backend.blocking:
+            return await to_thread.run_sync(getattr(self.backend, method), *args)
+        return getattr(self.backend, method)(*args)
+
+    async def key(self, namespace: str, path: str, query: Iterable[tuple[str, str]]) -> str:
+        generation = await self._call('generation', namespace)
+        normalized = '&'.join(f'{k}={v}' for k, v in sorted(query))
+        return f'{namespace}:{generation}:{path}?{normalized}'
+
+    async def get(self, key: str) -> Entry | None:
+        return await self._call('get', key)
+
+    async def set(self, key: str, entry: Entry) -> None:
+        await self._call('set', key, entry, self.ttl + max(self.stale_while_revalidate, self.stale_if_error))
+
+    def invalidate(self, *namespaces: str) -> None:
+        affected = set(namespaces).union(*(self.dependants.get(namespace, ()) for namespace in namespaces))
+        for namespace in affected:
+            self.backend.bump(namespace)
+
+    def invalidate_on_commit(self, session: AsyncSession, *namespaces: str) -> None:
+        session.sync_session.info.setdefault('response_cache', set()).update(namespaces)
+
+
+def _backend():
+    if settings.RESPONSE_CACHE_BACKEND == 'file':
+        return FileBackend(settings.RESPONSE_CACHE_DIR)
+    return MemoryBackend(settings.RESPONSE_CACHE_SIZE)
+
+
+response_cache = ResponseCache(
+    backend=_backend(),
+    ttl=settings.RESPONSE_CACHE_TTL,
+    stale_while_revalidate=settings.RESPONSE_CACHE_STALE_WHILE_REVALIDATE,
+    stale_if_error=settings.RESPONSE_CACHE_STALE_IF_ERROR,
+)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_responses(session: Session):
+    if namespaces := session.info.pop('response_cache', None):
+        response_cache.invalidate(*namespaces)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_responses(session: Session):
+    session.info.pop('response_cache', None)
+
+
+class ResponseCacheMiddleware:
+    """ Serves GET routes from response_cache: fresh entries as is, stale ones while refreshing them
+    in background or when the route fails, If-None-Match on a cached ETag is answered with 304.
+    """
+    validator_headers = (b'etag', b'last-modified', b'cache-control')
+
+    def __init__(self, app: ASGIApp, cache: ResponseCache = response_cache):
+        self.app = app
+        self.cache = cache
+        self._routes: dict[str, tuple[str, dict] | None] = {}
+        self._refreshing: dict[str, asyncio.Task] = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or scope['method'] != 'GET' or settings.RESPONSE_CACHE_BACKEND == 'none':
+            return await self.app(scope, receive, send)
+
+        # the key does not tell users apart
+        if any(name == b'authorization' for name, _ in scope['headers']):
+            return await self.app(scope, receive, send)
+
+        if (route := self._match(scope)) is None:
+            return await self.app(scope, receive, send)
+
+        namespace, defaults = route
+        given = {}
+        for name, value in parse_qsl(scope.get('query_string', b'').decode('latin-1')):
+            if name in defaults:
+                given.setdefault(name, []).append(value)
+        query = [(name, value) for name, default in defaults.items() for value in given.get(name, default)]
+        key = await self.cache.key(namespace, scope['path'], query)
+
+        entry = await self.cache.get(key)
+        age = time.time() - entry.stored_at if entry is not None else None
+
+        if entry is not None and age <= self.cache.ttl:
+            return await self._send_entry(scope, send, entry, b'HIT')
+
+        if entry is not None and age <= self.cache.ttl + self.cache.stale_while_revalidate:
+            if key not in self._refreshing:
+                task = asyncio.create_task(self._fetch(key, _without_conditionals(scope)))
+                self._refreshing[key] = task
+                task.add_done_callback(lambda _: self._refreshing.pop(key, None))
+            return await self._send_entry(scope, send, entry, b'STALE')
+
+        stale = entry if entry is not None and age <= self.cache.ttl + self.cache.stale_if_error else None
+        try:
+            status, headers, body = await self._fetch(key, scope, receive)
+        except Exception:
+            if stale is None:
+                raise
+            return await self._send_entry(scope, send, stale, b'STALE')
+
+        if status >= 500 and stale is not None:
+            return await self._send_entry(scope, send, stale, b'STALE')
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': [*headers, (b'x-cache', b'MISS')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def _match(self, scope: Scope) -> tuple[str, dict] | None:
+        """ Namespace and query defaults of the route serving the request, None unless it is cacheable.
+        Only the first full match serves the request, a later route matching the same path must not stand in for it.
+        """
+        for route in scope['app'].router.routes:
+            match, _ = route.matches(scope)
+            if match != Match.FULL:
+                continue
+            if not isinstance(route, APIRoute) or route.response_class is StreamingResponse:
+                return None
+            if route.unique_id not in self._routes:
+                self._routes[route.unique_id] = self._route_entry(route)
+            return self._routes[route.unique_id]
+        return None
+
+    def _route_entry(self, route: APIRoute) -> tuple[str, dict] | None:
+        if not route.tags or route.tags[0].lower() not in self.cache.namespaces:
+            return None
+        dependant = get_flat_dependant(route.dependant)
+        if dependant.security_requirements:     # permission checks run in the route, a cached body would skip them
+            return None
+        return route.tags[0].lower(), _query_defaults(dependant)
+
+    async def _fetch(self, key: str, scope: Scope, receive: Receive | None = None) -> tuple[int, list, bytes]:
+        """ Runs the route with the response buffered, 200 responses are stored."""
+        messages: list[Message] = []
+
+        async def empty_receive() -> Message:
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def buffer(message: Message) -> None:
+            messages.append(message)
+
+        await self.app(scope, receive or empty_receive, buffer)
+
+        start = next(message for message in messages if message['type'] == 'http.response.start')
+        body = b''.join(message.get('body', b'') for message in messages if message['type'] == 'http.response.body')
+        headers = [(k, v) for k, v in start.get('headers', []) if k.lower() != b'x-cache']
+        if start['status'] == 200:
+            await self.cache.set(key, Entry(status=200, headers=headers, body=body, stored_at=time.time()))
+        return start['status'], headers, body
+
+    async def _send_entry(self, scope: Scope, send: Send, entry: Entry, state: bytes) -> None:
+        if _not_modified(Headers(scope=scope), Headers(raw=entry.headers)):
+            headers = [(k, v) for k, v in entry.headers if k.lower() in self.validator_headers]
+            await send({'type': 'http.response.start', 'status': 304, 'headers': [*headers, (b'x-cache', state)]})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        await send({'type': 'http.response.start', 'status': entry.status, 'headers': [*entry.headers, (b'x-cache', state)]})
+        await send({'type': 'http.response.body', 'body': entry.body})
+
+
+def _not_modified(request: Headers, cached: Headers) -> bool:
+    if (if_none_match := request.get('if-none-match')) is not None:
+        tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        return '*' in tags or cached.get('etag', '').removeprefix('W/') in tags
+    if (if_modified_since := request.get('if-modified-since')) is not None and 'last-modified' in cached:
+        try:
+            return parsedate_to_datetime(cached['last-modified']) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _query_defaults(dependant: Dependant) -> dict[str, tuple]:
+    """ Known query parameters of a route with their defaults, unknown ones never reach the key."""
+    defaults = {}
+    for field in dependant.query_params:
+        default = field.field_info.default
+        defaults[field.alias] = (str(default),) if not field.required and default is not None else ()
+    return defaults
+
+
+def _without_conditionals(scope: Scope) -> Scope:
+    headers = [(k, v) for k, v in scope['headers'] if k not in (b'if-none-match', b'if-modified-since')]
+    return {**scope, 'headers': headers}
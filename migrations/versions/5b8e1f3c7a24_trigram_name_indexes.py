@@ -0,0 +1,48 @@
+"""trigram name indexes
+
+Revision ID: 5b8e1f3c7a24
+Revises: c41d7a5e2b90
+Create Date: 2026-10-18 11:04:52.271828
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b8e1f3c7a24'
+down_revision: Union[str, None] = 'c41d7a5e2b90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+indexes = (
+    ('aircrafts', 'name'),
+    ('countries', 'name'),
+    ('countries', 'region'),
+    ('cities', 'name'),
+    ('cities', 'name_ru'),
+    ('cities', 'timezone'),
+    ('airports', 'name'),
+    ('airports', 'name_ru'),
+    ('companies', 'name'),
+)
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # CONCURRENTLY can not run inside a transaction block
+    with op.get_context().autocommit_block():
+        for table, column in indexes:
+            op.create_index(
+                f'ix_{table}_{column}_trgm', table, [column], unique=False,
+                postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'},
+                postgresql_concurrently=True, if_not_exists=True,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for table, column in reversed(indexes):
+            op.drop_index(f'ix_{table}_{column}_trgm', table_name=table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,54 @@
+"""flight stats
+
+Revision ID: 8d2a6c0f4e17
+Revises: 5b8e1f3c7a24
+Create Date: 2026-10-18 14:21:37.518402
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8d2a6c0f4e17'
+down_revision: Union[str, None] = '5b8e1f3c7a24'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('flight_stats',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('airport_iata', sa.String(length=3), nullable=True),
+    sa.Column('company_iata', sa.String(length=2), nullable=False),
+    sa.Column('direction', postgresql.ENUM('arrival', 'departure', name='direction', create_type=False), nullable=False),
+    sa.Column('flight_count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_flight_stats_key', 'flight_stats', ['day', 'airport_iata', 'company_iata', 'direction'], unique=True, postgresql_nulls_not_distinct=True)
+    op.create_index('ix_flight_stats_airport_iata_day', 'flight_stats', ['airport_iata', 'day'], unique=False)
+    op.create_index('ix_flight_stats_company_iata_day', 'flight_stats', ['company_iata', 'day'], unique=False)
+
+    # same keys as FlightStatsRepository.keys: mar1 and mar2 once each, null when a flight has neither
+    op.execute("""
+        INSERT INTO flight_stats (day, airport_iata, company_iata, direction, flight_count)
+        SELECT (flights.sked_local AT TIME ZONE 'UTC')::date, route.iata, flights.company_iata, flights.direction, count(*)
+        FROM flights
+        CROSS JOIN LATERAL (
+            SELECT DISTINCT iata FROM (VALUES (flights.mar1_iata), (flights.mar2_iata)) AS marks (iata)
+            WHERE iata IS NOT NULL OR (flights.mar1_iata IS NULL AND flights.mar2_iata IS NULL)
+        ) AS route
+        WHERE flights.sked_local IS NOT NULL
+        GROUP BY 1, 2, 3, 4
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_flight_stats_company_iata_day', table_name='flight_stats')
+    op.drop_index('ix_flight_stats_airport_iata_day', table_name='flight_stats')
+    op.drop_index('ix_flight_stats_key', table_name='flight_stats')
+    op.drop_table('flight_stats')
@@ -0,0 +1,42 @@
+"""flight batches
+
+Revision ID: a7c3e5f19b08
+Revises: e3b94d1a6f52
+Create Date: 2026-10-18 18:37:52.116204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7c3e5f19b08'
+down_revision: Union[str, None] = 'e3b94d1a6f52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('flight_batches',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.Enum('pending', 'applied', 'failed', name='batchstatus'), nullable=False),
+    sa.Column('flights', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('received', sa.Integer(), nullable=False),
+    sa.Column('upserted', sa.Integer(), nullable=True),
+    sa.Column('superseded', sa.Integer(), nullable=True),
+    sa.Column('changed', sa.Integer(), nullable=True),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('created_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('updated_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_flight_batches_pending', 'flight_batches', ['id'], unique=False, postgresql_where=sa.text("status = 'pending'"))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_flight_batches_pending', table_name='flight_batches', postgresql_where=sa.text("status = 'pending'"))
+    op.drop_table('flight_batches')
+    sa.Enum(name='batchstatus').drop(op.get_bind(), checkfirst=False)
@@ -0,0 +1,43 @@
+"""flight query indexes
+
+Revision ID: c41d7a5e2b90
+Revises: 90f1901ad3ed
+Create Date: 2026-10-18 10:12:31.415926
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c41d7a5e2b90'
+down_revision: Union[str, None] = '90f1901ad3ed'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+indexes = (
+    ('ix_flights_sked_local_id', 'flights', ['sked_local', 'id']),
+    ('ix_flights_company_iata_sked_local', 'flights', ['company_iata', 'sked_local']),
+    ('ix_flights_mar1_iata_sked_local', 'flights', ['mar1_iata', 'sked_local']),
+    ('ix_flights_mar2_iata_sked_local', 'flights', ['mar2_iata', 'sked_local']),
+    ('ix_flights_direction_sked_local', 'flights', ['direction', 'sked_local']),
+    ('ix_flights_gate_id_sked_local', 'flights', ['gate_id', 'sked_local']),
+    ('ix_flights_number_sked_local', 'flights', ['number', 'sked_local']),
+    ('ix_airports_city_name', 'airports', ['city_name']),
+    ('ix_cities_country_name', 'cities', ['country_name']),
+)
+
+
+def upgrade() -> None:
+    # CONCURRENTLY can not run inside a transaction block
+    with op.get_context().autocommit_block():
+        for name, table, columns in indexes:
+            op.create_index(name, table, columns, unique=False, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(indexes):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,95 @@
+"""partition flights_changelog by month
+
+Revision ID: e3b94d1a6f52
+Revises: 8d2a6c0f4e17
+Create Date: 2026-10-18 16:02:11.904317
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e3b94d1a6f52'
+down_revision: Union[str, None] = '8d2a6c0f4e17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# monthly partitions from the oldest row up to 3 months ahead, named as app.flights_api.partitions does
+CREATE_PARTITIONS = """
+DO $$
+DECLARE
+    month timestamp;
+BEGIN
+    FOR month IN
+        SELECT generate_series(
+            date_trunc('month', least(min(created_at), now()) AT TIME ZONE 'UTC'),
+            date_trunc('month', now() AT TIME ZONE 'UTC') + interval '3 months',
+            interval '1 month'
+        )
+        FROM flights_changelog_unpartitioned
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF flights_changelog FOR VALUES FROM (%L) TO (%L)',
+            'flights_changelog_' || to_char(month, '"y"YYYY"m"MM'),
+            month AT TIME ZONE 'UTC',
+            (month + interval '1 month') AT TIME ZONE 'UTC'
+        );
+    END LOOP;
+END $$
+"""
+
+
+def upgrade() -> None:
+    op.rename_table('flights_changelog', 'flights_changelog_unpartitioned')
+    op.execute('ALTER INDEX flights_changelog_pkey RENAME TO flights_changelog_unpartitioned_pkey')
+    op.execute('ALTER INDEX ix_flights_changelog_flight_id RENAME TO ix_flights_changelog_unpartitioned_flight_id')
+
+    op.create_table('flights_changelog',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('flights_changelog_id_seq')"), nullable=False),
+    sa.Column('flight_id', sa.Integer(), nullable=False),
+    sa.Column('field', sa.String(), nullable=False),
+    sa.Column('old_value', sa.String(), nullable=True),
+    sa.Column('created_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['flight_id'], ['flights.id'], ondelete='set null'),
+    sa.PrimaryKeyConstraint('id', 'created_at'),
+    postgresql_partition_by='RANGE (created_at)',
+    )
+    op.execute('ALTER SEQUENCE flights_changelog_id_seq OWNED BY flights_changelog.id')
+    op.create_index(op.f('ix_flights_changelog_flight_id'), 'flights_changelog', ['flight_id'], unique=False)
+    op.execute('CREATE TABLE flights_changelog_default PARTITION OF flights_changelog DEFAULT')
+    op.execute(CREATE_PARTITIONS)
+
+    op.execute(
+        'INSERT INTO flights_changelog (id, flight_id, field, old_value, created_at) '
+        'SELECT id, flight_id, field, old_value, created_at FROM flights_changelog_unpartitioned'
+    )
+    op.drop_table('flights_changelog_unpartitioned')
+
+
+def downgrade() -> None:
+    op.rename_table('flights_changelog', 'flights_changelog_partitioned')
+    op.execute('ALTER INDEX flights_changelog_pkey RENAME TO flights_changelog_partitioned_pkey')
+    op.execute('ALTER INDEX ix_flights_changelog_flight_id RENAME TO ix_flights_changelog_partitioned_flight_id')
+
+    op.create_table('flights_changelog',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('flights_changelog_id_seq')"), nullable=False),
+    sa.Column('flight_id', sa.Integer(), nullable=False),
+    sa.Column('field', sa.String(), nullable=False),
+    sa.Column('old_value', sa.String(), nullable=True),
+    sa.Column('created_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['flight_id'], ['flights.id'], ondelete='set null'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute('ALTER SEQUENCE flights_changelog_id_seq OWNED BY flights_changelog.id')
+    op.create_index(op.f('ix_flights_changelog_flight_id'), 'flights_changelog', ['flight_id'], unique=False)
+
+    # detached partitions are not part of the table any more and are left as they are
+    op.execute(
+        'INSERT INTO flights_changelog (id, flight_id, field, old_value, created_at) '
+        'SELECT id, flight_id, field, old_value, created_at FROM flights_changelog_partitioned'
+    )
+    op.drop_table('flights_changelog_partitioned')
@@ -0,0 +1,32 @@
+"""content hash
+
+Revision ID: f4d81b2c6e39
+Revises: a7c3e5f19b08
+Create Date: 2026-10-18 19:24:08.530761
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f4d81b2c6e39'
+down_revision: Union[str, None] = 'a7c3e5f19b08'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+TABLES = ('aircrafts', 'countries', 'cities', 'airports', 'companies', 'flights')
+
+
+def upgrade() -> None:
+    # stays null until the next upsert of a row, which stores it without a changelog entry
+    for table in TABLES:
+        op.add_column(table, sa.Column('content_hash', sa.String(length=32), nullable=True))
+
+
+def downgrade() -> None:
+    for table in TABLES:
+        op.drop_column(table, 'content_hash')
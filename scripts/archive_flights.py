@@ -0,0 +1,70 @@
+""" Moves flights sked more than --months months ago and their changelog out of the database into ARCHIVE_DIR.
+
+    python -m scripts.archive_flights --months 12
+
+Writes one compressed file per UTC month, FlightService reads archived months through transparently.
+flights_changelog partitions of the archived months left empty are detached and dropped.
+"""
+import argparse
+import asyncio
+import sys
+from datetime import datetime, timezone
+
+from sqlalchemy import Connection, func, select, text
+
+from app.config import settings
+from app.database import async_engine, async_session
+from app.flights_api import models, partitions, services
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--months', type=int, default=12, help='months kept in the database besides the current one')
+parser.add_argument('--dry-run', action='store_true', help='only list the months to archive')
+args = parser.parse_args()
+
+
+def drop_empty_partitions(connection: Connection, before) -> list[str]:
+    table = models.FlightsChangelogModel.__table__
+    dropped = []
+    for name, month in sorted(partitions.attached(connection, table).items(), key=lambda item: item[1] or before):
+        if month is None or month >= before:
+            continue
+        if connection.execute(text(f'SELECT EXISTS (SELECT FROM {name})')).scalar_one():
+            continue
+        connection.execute(text(f'ALTER TABLE {table.name} DETACH PARTITION {name}'))
+        connection.execute(text(f'DROP TABLE {name}'))
+        dropped.append(name)
+    return dropped
+
+
+async def main():
+    cutoff = partitions.add_months(datetime.now(timezone.utc).date().replace(day=1), -args.months)
+    repo = services.FlightService.repo
+    flights = models.FlightModel
+
+    async with async_session() as session:
+        month_column = func.date_trunc('month', func.timezone('UTC', flights.sked_local))
+        query = select(month_column).filter(flights.sked_local < datetime(cutoff.year, cutoff.month, 1, tzinfo=timezone.utc)).distinct()
+        months = sorted(month.date() for month in (await session.execute(query)).scalars())
+
+    print(f'Archiving {len(months)} month(s) before {cutoff:%Y-%m} into {settings.ARCHIVE_DIR}')
+    for month in months:
+        if args.dry_run:
+            print(f'{month:%Y-%m}')
+            continue
+        async with async_session() as session, session.begin():
+            count = await repo.archive_month(session, month)
+        print(f'{month:%Y-%m}: {count} flights')
+
+    if not args.dry_run:
+        async with async_engine.begin() as conn:
+            dropped = await conn.run_sync(drop_empty_partitions, cutoff)
+        print(f'Dropped partitions: {", ".join(dropped) or "none"}')
+
+    await async_engine.dispose()
+
+
+if __name__ == '__main__':
+    if sys.platform == "win32":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    asyncio.run(main())
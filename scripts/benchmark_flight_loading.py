@@ -0,0 +1,94 @@
+""" Compares FLIGHT_RELATIONS_LOADING strategies on a page of flights from the configured database.
+
+    python -m scripts.benchmark_flight_loading --days 7 --limit 100 --repeat 20
+
+For every strategy prints the statements per page, the widest result set in columns,
+the total fetched rows and cells, and the median / p95 latency of FlightService.get_many.
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import event
+
+from app.config import settings
+from app.database import async_engine, async_session
+from app.flights_api import caches, schemas, services
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--days', type=int, default=7, help='date range ending now')
+parser.add_argument('--limit', type=int, default=100)
+parser.add_argument('--repeat', type=int, default=20)
+parser.add_argument('--strategies', nargs='+', default=['joined', 'batched', 'cache'])
+args = parser.parse_args()
+
+
+class Stats:
+    def __init__(self):
+        self.statements = 0
+        self.width = 0
+        self.rows = 0
+        self.cells = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if cursor.description is None:
+            return
+        rows = cursor.rowcount if cursor.rowcount >= 0 else 0
+        self.statements += 1
+        self.width = max(self.width, len(cursor.description))
+        self.rows += rows
+        self.cells += rows * len(cursor.description)
+
+
+async def run(strategy: str) -> None:
+    settings.FLIGHT_RELATIONS_LOADING = strategy
+    date_end = datetime.now(timezone.utc)
+    params = schemas.FlightExportQuerySchema(date_start=date_end - timedelta(days=args.days), date_end=date_end)
+    paging = schemas.CursorPagingSchema(limit=args.limit)
+    await caches.references.load()
+
+    async def page():
+        async with async_session() as session:
+            return await services.FlightService.get_many(
+                session, paging=paging, order_by='sked_local', **params.model_dump(by_alias=True, exclude_none=True)
+            )
+
+    await page()    # warm up connections and compiled statement cache
+
+    stats = Stats()
+    event.listen(async_engine.sync_engine, 'after_cursor_execute', stats)
+    timings = []
+    try:
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = await page()
+            timings.append((time.perf_counter() - start) * 1000)
+    finally:
+        event.remove(async_engine.sync_engine, 'after_cursor_execute', stats)
+
+    timings.sort()
+    print(
+        f'{strategy:>8}: items={result["count"]:<5} '
+        f'statements={stats.statements / args.repeat:<4.1f} '
+        f'width={stats.width:<4} '
+        f'rows={stats.rows // args.repeat:<6} '
+        f'cells={stats.cells // args.repeat:<8} '
+        f'median={statistics.median(timings):.1f}ms '
+        f'p95={timings[int(len(timings) * 0.95) - 1 if len(timings) > 1 else 0]:.1f}ms'
+    )
+
+
+async def main():
+    for strategy in args.strategies:
+        await run(strategy)
+    await async_engine.dispose()
+
+
+if __name__ == '__main__':
+    if sys.platform == "win32":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    asyncio.run(main())
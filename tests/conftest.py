@@ -7,7 +7,9 @@ from app.auth.permissions import UserRole, UserState
 from app.auth.security import create_access_token
 from app.config import settings
 from app.database import async_engine
+from app.flights_api import caches
 from app.main import app
+from app.response_cache import response_cache
 from app.models import Base
 from tests.utils import registered_user
 
@@ -34,6 +36,9 @@ async def recreate_tables():
         await conn.run_sync(Base.metadata.drop_all)
         await async_engine.dispose()        # to prevent sqlalchemy cache lookup exceptions
         await conn.run_sync(Base.metadata.create_all)
+    caches.references.invalidate()
+    caches.confirmed.clear()
+    response_cache.backend.clear()
 
 
 @pytest.fixture(scope='session')
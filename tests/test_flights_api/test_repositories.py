@@ -0,0 +1,28 @@
+import pytest
+from pydantic import BaseModel, Field, create_model
+
+from app.flights_api import repositories
+
+
+@pytest.mark.parametrize('alias', (
+        'wingspan',
+        'ilike::UnknownModel^name',
+        'regexp::name',
+        'between@name',
+        'name;drop',
+))
+def test_compile_filters_rejects_bad_alias(alias):
+    schema = create_model('QuerySchema', value=(str | None, Field(None, serialization_alias=alias)))
+
+    with pytest.raises(ValueError):
+        repositories.AircraftRepository().compile_filters(schema)
+
+
+def test_compile_filters():
+    class QuerySchema(BaseModel):
+        name: str | None = Field(None, serialization_alias='ilike::name')
+
+    filters = repositories.AircraftRepository().compile_filters(QuerySchema)
+
+    assert list(filters) == ['ilike::name']
+    assert filters['ilike::name'].operation == 'ilike'
@@ -1,9 +1,15 @@
+import gzip
+import json
 from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
 
 import pytest
-from sqlalchemy import select
+from sqlalchemy import func, select, text, update
+from sqlalchemy.exc import OperationalError
 
-from app.flights_api import models
+from app.config import settings
+from app.flights_api import ingestion, models, partitions, schemas, services, utils
+from app.flights_api.archive import FlightArchive
 from .payload import (
     aircraft,
     company,
@@ -276,6 +282,59 @@ class TestAirport:
         assert updated_first_airport.name == 'Abakan'
         assert updated_first_airport.city_name == 'new'
 
+    async def test_get_many_by_flights(self, session, client, random_superuser_headers):
+        su, s7 = company(iata='SU'), company(iata='S7')
+        data = [
+            flight(orig_id=1, mar1=airport(iata='KHV'), mar2=airport(iata='SVO'), company=su, direction='departure', sked_local=dt_string(days=-3)),
+            flight(orig_id=2, mar1=airport(iata='LED'), mar2=None, company=s7, direction='departure', sked_local=dt_string(days=-4)),
+            flight(orig_id=3, mar1=airport(iata='AER'), mar2=None, company=su, direction='departure', sked_local=dt_string(days=-10)),
+        ]
+        client.put('/flights', json=data, headers=random_superuser_headers)
+        params = dict(date_start=dt_string(days=-5), date_end=dt_string(days=0))
+
+        airports = client.get('/airports', params=dict(params, company='SU', direction='departure')).json()
+        companies = client.get('/companies', params=dict(params, airport='LED')).json()
+        client.put('/flights', json=[dict(data[0], mar1=airport(iata='OVB'))], headers=random_superuser_headers)
+        moved = client.get('/airports', params=dict(params, company='SU')).json()
+        stats = (await session.execute(select(models.FlightStatsModel).filter_by(airport_iata='KHV'))).scalars().all()
+
+        assert sorted(item['iata'] for item in airports['items']) == ['KHV', 'SVO']
+        assert [item['iata'] for item in companies['items']] == ['S7']
+        assert sorted(item['iata'] for item in moved['items']) == ['OVB', 'SVO']
+        assert [row.flight_count for row in stats] == [0]
+
+    async def test_get_one_cached(self, client, random_superuser_headers):
+        client.put('/airports', json=[airport(iata='ABA', name='first')], headers=random_superuser_headers)
+        client.put('/flights', json=[flight(orig_id=1, mar1=airport(iata='ABA', name='first'))], headers=random_superuser_headers)
+        assert client.get('/airports/ABA').json()['name'] == 'first'
+
+        client.put('/airports', json=[airport(iata='ABA', name='Abakan')], headers=random_superuser_headers)
+
+        assert client.get('/airports/ABA').json()['name'] == 'Abakan'
+        assert client.get('/flights/1').json()['mar1']['name'] == 'Abakan'
+
+    @pytest.mark.parametrize('path', ('/airports/ABA', '/airports'))
+    async def test_get_not_modified(self, path, client, random_superuser_headers):
+        client.put('/airports', json=[airport(iata='ABA', name='first')], headers=random_superuser_headers)
+
+        response = client.get(path)
+        etag, last_modified = response.headers['etag'], response.headers['last-modified']
+        not_modified = client.get(path, headers={'If-None-Match': etag})
+        not_modified_since = client.get(path, headers={'If-Modified-Since': last_modified})
+        other_query = client.get(path, params=dict(page=2), headers={'If-None-Match': etag})
+
+        client.put('/airports', json=[airport(iata='ABA', name='Abakan')], headers=random_superuser_headers)
+        modified = client.get(path, headers={'If-None-Match': etag})
+
+        assert response.status_code == 200
+        assert not_modified.status_code == 304
+        assert not_modified.headers['etag'] == etag
+        assert not not_modified.content
+        assert not_modified_since.status_code == 304
+        assert other_query.status_code == 200
+        assert modified.status_code == 200
+        assert modified.headers['etag'] != etag
+
     @pytest.mark.parametrize(
         "data, params, expect",
         (
@@ -365,6 +424,163 @@ class TestFlight:
         assert updated_first_flight.company_iata == 'N4'
         assert updated_first_flight.mar1_iata == 'KGF'
 
+    async def test_upsert_changelog(self, session, client, random_superuser_headers):
+        data = flight(orig_id=1, gate_id='A1', term_local='B')
+        client.put('/flights', json=[data], headers=random_superuser_headers)
+        client.put('/flights', json=[data], headers=random_superuser_headers)
+        client.put('/flights', json=[dict(data, gate_id='C2', term_local='D')], headers=random_superuser_headers)
+
+        response = client.get('/flights/1', params=dict(changelog=True))
+        content = response.json()
+
+        assert response.status_code == 200
+        assert content['gate_id'] == 'C2'
+        assert {(c['field'], c['old_value']) for c in content['changelog']} == {('gate_id', 'A1'), ('term_local', 'B')}
+
+    async def test_upsert_content_hash(self, session, client, random_superuser_headers):
+        data = [flight(orig_id=1, gate_id='A1', company=company(iata='SU'))]
+        query = select(models.FlightModel.content_hash, models.FlightModel.updated_at).filter_by(orig_id=1)
+        client.put('/flights', json=data, headers=random_superuser_headers)
+        first = (await session.execute(query)).one()
+        client.put('/flights', json=data, headers=random_superuser_headers)
+        repeated = (await session.execute(query)).one()
+        await session.execute(update(models.FlightModel).values(content_hash=None))
+        await session.commit()
+        client.put('/flights', json=data, headers=random_superuser_headers)
+        rehashed = (await session.execute(query)).one()
+        client.put('/flights', json=[dict(data[0], gate_id='B2')], headers=random_superuser_headers)
+        changed = (await session.execute(query)).one()
+        company_hash = (await session.execute(select(models.CompanyModel.content_hash).filter_by(iata='SU'))).scalar_one()
+        changelog = client.get('/flights/1', params=dict(changelog=True)).json()['changelog']
+
+        assert first.content_hash is not None and company_hash is not None
+        assert repeated == first
+        assert rehashed.content_hash == first.content_hash
+        assert changed.content_hash != first.content_hash
+        assert [(c['field'], c['old_value']) for c in changelog] == [('gate_id', 'A1')]
+
+    async def test_upsert_confirmed_references(self, session, client, random_superuser_headers):
+        data = [flight(orig_id=1, company=company(iata='SU', name='Aeroflot'))]
+        name_query = select(models.CompanyModel.name).filter_by(iata='SU')
+        client.put('/flights', json=data, headers=random_superuser_headers)
+        # as if changed by another worker
+        await session.execute(update(models.CompanyModel).filter_by(iata='SU').values(name='Other'))
+        await session.commit()
+        client.put('/flights', json=[dict(data[0], gate_id='B2')], headers=random_superuser_headers)
+        skipped = (await session.execute(name_query)).scalar_one()
+        client.put('/companies', json=[company(iata='SU', name='Renamed')], headers=random_superuser_headers)
+        client.put('/flights', json=data, headers=random_superuser_headers)
+        upserted = (await session.execute(name_query)).scalar_one()
+
+        assert skipped == 'Other'
+        assert upserted == 'Aeroflot'
+
+    async def test_upsert_queued(self, session, client, random_superuser_headers, monkeypatch):
+        monkeypatch.setattr(settings, 'FLIGHT_INGESTION', 'queue')
+        data = flight(orig_id=1, gate_id='A1')
+        first = client.put('/flights', json=[data, flight(orig_id=2)], headers=random_superuser_headers)
+        second = client.put('/flights', json=[dict(data, gate_id='B2')], headers=random_superuser_headers)
+        pending = client.get(f'/flights/batches/{first.json()["id"]}', headers=random_superuser_headers).json()
+
+        applied = await ingestion.apply_pending()
+        stored = (await session.execute(select(models.FlightModel.gate_id).filter_by(orig_id=1))).scalar_one()
+        batches = [client.get(f'/flights/batches/{r.json()["id"]}', headers=random_superuser_headers).json() for r in (first, second)]
+
+        assert first.status_code == second.status_code == 202
+        assert (pending['status'], pending['received'], pending['upserted']) == ('pending', 2, None)
+        assert applied == 2
+        assert stored == 'B2'
+        assert [(b['status'], b['upserted'], b['superseded']) for b in batches] == [('applied', 1, 1), ('applied', 1, 0)]
+        assert client.get('/flights/batches/0', headers=random_superuser_headers).status_code == 404
+        assert 'x-cache' not in client.get(f'/flights/batches/{first.json()["id"]}', headers=random_superuser_headers).headers
+        assert client.get(f'/flights/batches/{first.json()["id"]}').status_code == 401
+
+    async def test_upsert_queued_transient_error(self, client, random_superuser_headers, monkeypatch):
+        monkeypatch.setattr(settings, 'FLIGHT_INGESTION', 'queue')
+        batch = client.put('/flights', json=[flight(orig_id=1)], headers=random_superuser_headers).json()
+
+        async def lost_connection(*args, **kwargs):
+            raise OperationalError('INSERT', {}, Exception('server closed the connection unexpectedly'))
+
+        monkeypatch.setattr(services.FlightService, 'upsert_many', lost_connection)
+        with pytest.raises(OperationalError):
+            await ingestion.apply_pending()
+        monkeypatch.undo()
+
+        assert client.get(f'/flights/batches/{batch["id"]}', headers=random_superuser_headers).json()['status'] == 'pending'
+
+    async def test_upsert_stream_record_too_large(self, client, random_superuser_headers, monkeypatch):
+        monkeypatch.setattr(settings, 'INGESTION_MAX_RECORD_SIZE', 1024)
+        body = json.dumps(flight(orig_id=1)).encode() + b'\n' + b' ' * 4096
+        headers = dict(random_superuser_headers, **{'Content-Type': 'application/x-ndjson'})
+
+        response = client.put('/flights/stream', content=body, headers=headers)
+
+        assert response.status_code == 400
+
+    async def test_changelog_partitioned(self, session, client, random_superuser_headers):
+        data = flight(orig_id=1, gate_id='A1')
+        client.put('/flights', json=[data], headers=random_superuser_headers)
+        client.put('/flights', json=[dict(data, gate_id='C2')], headers=random_superuser_headers)
+        table = models.FlightsChangelogModel.__table__
+        this_month = datetime.now(timezone.utc).date().replace(day=1)
+
+        stored_in = (await session.execute(text('SELECT DISTINCT tableoid::regclass::text FROM flights_changelog'))).scalars().all()
+        connection = await session.connection()
+        detached = await connection.run_sync(partitions.detach_partitions, table, partitions.add_months(this_month, 1))
+        left = (await session.execute(select(func.count()).select_from(table))).scalar_one()
+        await session.rollback()
+
+        assert stored_in == [partitions.partition_name(table, this_month)]
+        assert detached == [partitions.partition_name(table, this_month)]
+        assert left == 0
+
+    @pytest.mark.parametrize('rendering', ('python', 'database'))
+    async def test_archive_read_through(self, rendering, session, client, random_superuser_headers, tmp_path, monkeypatch):
+        monkeypatch.setattr(services.FlightService.repo, 'archive', FlightArchive(str(tmp_path)))
+        monkeypatch.setattr(settings, 'FLIGHT_RENDERING', rendering)
+        month = partitions.add_months(datetime.now(timezone.utc).date().replace(day=1), -13)
+        sked = datetime(month.year, month.month, 15, 12, tzinfo=timezone.utc)
+        data = [flight(orig_id=n, sked_local=(sked + timedelta(hours=n)).isoformat(), gate_id='A1') for n in (1, 2)]
+        client.put('/flights', json=data, headers=random_superuser_headers)
+        client.put('/flights', json=[dict(data[0], gate_id='B2')], headers=random_superuser_headers)
+
+        archived = await services.FlightService.repo.archive_month(session, month)
+        await session.commit()
+        stored = (await session.execute(select(func.count()).select_from(models.FlightModel))).scalar_one()
+        params = dict(date_start=(sked - timedelta(days=1)).isoformat(), date_end=(sked + timedelta(days=1)).isoformat())
+        page = client.get('/flights', params=params).json()
+        keyset_page = client.get('/flights', params=dict(params, cursor='', limit=1)).json()
+        trimmed = client.get('/flights', params=dict(params, fields='number,gate_id', count='none')).json()
+        one = client.get('/flights/1').json()
+
+        assert (archived, stored) == (2, 0)
+        assert [item['orig_id'] for item in page['items']] == [1, 2]
+        assert [item['orig_id'] for item in keyset_page['items']] == [1] and keyset_page['next'] is not None
+        assert trimmed['total'] is None and [sorted(item) for item in trimmed['items']] == [['gate_id', 'number']] * 2
+        assert one['gate_id'] == 'B2'
+        assert [(c['field'], c['old_value']) for c in one['changelog']] == [('gate_id', 'A1')]
+
+    @pytest.mark.parametrize('compressed', (False, True))
+    async def test_upsert_stream(self, compressed, session, client, random_superuser_headers):
+        data = [flight(orig_id=n) for n in range(1, 6)]
+        lines = [json.dumps(d) for d in data[:2]] + ['{"not": "valid"}', ''] + [json.dumps(d) for d in data[2:]]
+        body = '\n'.join(lines).encode()
+        headers = dict(random_superuser_headers, **{'Content-Type': 'application/x-ndjson'})
+        if compressed:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        response = client.put('/flights/stream', content=body, params=dict(chunk_size=2), headers=headers)
+        content = response.json()
+
+        assert response.status_code == 200
+        assert [chunk['received'] for chunk in content] == [2, 2, 2]
+        assert [chunk['upserted'] for chunk in content] == [2, 1, 2]
+        assert content[1]['errors'][0]['line'] == 3
+        stored = (await session.execute(select(models.FlightModel.orig_id))).scalars().all()
+        assert sorted(stored) == [1, 2, 3, 4, 5]
+
     @pytest.mark.parametrize(
         "data, params, expect",
         (
@@ -446,6 +662,245 @@ class TestFlight:
         assert compare(data2, content[1])
         assert compare(data1, content[2])
 
+    async def test_get_many_response_cache(self, client, random_superuser_headers):
+        client.put('/flights', json=[flight(orig_id=1, gate_id='A1')], headers=random_superuser_headers)
+        params = dict(date_start=dt_string(days=-5), date_end=dt_string(days=1))
+
+        miss = client.get('/flights', params=params)
+        hit = client.get('/flights', params=dict(params, unknown='ignored'))
+        client.put('/flights', json=[flight(orig_id=1, gate_id='B2')], headers=random_superuser_headers)
+        invalidated = client.get('/flights', params=params)
+
+        assert miss.headers['x-cache'] == 'MISS'
+        assert hit.headers['x-cache'] == 'HIT'
+        assert hit.json() == miss.json()
+        assert invalidated.headers['x-cache'] == 'MISS'
+        assert invalidated.json()['items'][0]['gate_id'] == 'B2'
+
+    async def test_get_many_fast_serialization(self, client, random_superuser_headers, monkeypatch):
+        monkeypatch.setattr(settings, 'RESPONSE_CACHE_BACKEND', 'none')
+        data = [flight(mar1=airport(name_ru='Шереметьево', lat=55.972778)), flight(mar2=None), flight()]
+        client.put('/flights', json=data, headers=random_superuser_headers)
+        params = dict(date_start=dt_string(days=-5), date_end=dt_string(days=1))
+
+        fast = client.get('/flights', params=params)
+        monkeypatch.setattr(settings, 'FAST_SERIALIZATION', False)
+        standard = client.get('/flights', params=params)
+
+        assert fast.status_code == 200
+        assert fast.content == standard.content
+
+    @pytest.mark.parametrize('loading', ('joined', 'batched', 'cache'))
+    async def test_relations_loading(self, loading, client, random_superuser_headers, monkeypatch):
+        monkeypatch.setattr(settings, 'FLIGHT_RELATIONS_LOADING', loading)
+        data = [flight(orig_id=1, mar1=airport(iata='KHV'), mar2=None), flight(orig_id=2, mar1=airport(iata='KHV'))]
+        client.put('/flights', json=data, headers=random_superuser_headers)
+        params = dict(date_start=dt_string(days=-5), date_end=dt_string(days=1))
+
+        page = client.get('/flights', params=params).json()
+        one = client.get('/flights/1').json()
+        by_ids = client.post('/flights', json=[2, 1]).json()
+
+        assert sorted(item['orig_id'] for item in page['items']) == [1, 2]
+        assert compare(data[0], one)
+        assert compare(data[1], by_ids[0])
+        assert by_ids[1]['mar2'] is None
+
+    @pytest.mark.parametrize('fieldset, status_code, keys', (
+            (dict(fields='number,sked_local,mar1'), 200, ['mar1', 'number', 'sked_local']),
+            (dict(exclude='changelog,mar3,mar4,mar5'), 200, None),
+            (dict(fields='number', shape='sideloaded'), 200, ['number']),
+            (dict(fields='number,unknown'), 400, None),
+            (dict(fields='number', exclude='number'), 400, None),
+    ))
+    async def test_get_many_fieldset(self, fieldset, status_code, keys, client, random_superuser_headers):
+        client.put('/flights', json=[flight(), flight()], headers=random_superuser_headers)
+        params = dict(date_start=dt_string(days=-5), date_end=dt_string(days=1), **fieldset)
+
+        response = client.get('/flights', params=params)
+
+        assert response.status_code == status_code
+        if status_code == 200:
+            items = response.json()['items']
+            expected = keys or sorted(set(schemas.FlightResponseSchema.model_fields) - set(fieldset['exclude'].split(',')))
+            assert len(items) == 2
+            assert all(sorted(item) == expected for item in items)
+
+    async def test_get_many_sideloaded(self, client, random_superuser_headers):
+        data = [flight(mar1=airport(iata='KHV'), mar2=airport(iata='SVO')), flight(mar1=airport(iata='SVO'), mar2=None)]
+        client.put('/flights', json=data, headers=random_superuser_headers)
+        params = dict(date_start=dt_string(days=-5), date_end=dt_string(days=1), shape='sideloaded')
+
+        response = client.get('/flights', params=params)
+        content = response.json()
+        included = content['included']
+
+        assert response.status_code == 200
+        assert sorted(included['airports']) == ['KHV', 'SVO']
+        for item in content['items']:
+            assert item['company'] in included['companies']
+            assert item['aircraft'] in included['aircrafts']
+            assert all(item[mar] is None or item[mar] in included['airports'] for mar in ('mar1', 'mar2', 'mar3', 'mar4', 'mar5'))
+        assert compare(data[0]['mar1'], included['airports']['KHV'])
+
+    async def test_reference_cache_caught_up(self, session, client, random_superuser_headers, monkeypatch):
+        monkeypatch.setattr(settings, 'RESPONSE_CACHE_BACKEND', 'none')
+        client.put('/flights', json=[flight(company=company(iata='SU', name='Aeroflot'))], headers=random_superuser_headers)
+        params = dict(date_start=dt_string(days=-5), date_end=dt_string(days=1))
+        cached = client.get('/flights', params=params)
+        # as if changed by another worker, this one's cache is not invalidated
+        await session.execute(update(models.CompanyModel).filter_by(iata='SU').values(name='Renamed', updated_at=datetime.now(timezone.utc)))
+        await session.commit()
+        fresh = client.get('/flights', params=params, headers={'If-None-Match': cached.headers['etag']})
+
+        assert cached.json()['items'][0]['company']['name'] == 'Aeroflot'
+        assert fresh.status_code == 200
+        assert fresh.json()['items'][0]['company']['name'] == 'Renamed'
+
+    @pytest.mark.parametrize('paging', ({}, {'cursor': ''}))
+    async def test_database_rendering(self, paging, client, random_superuser_headers, monkeypatch):
+        monkeypatch.setattr(settings, 'RESPONSE_CACHE_BACKEND', 'none')
+        data = [flight(mar1=airport(iata='KHV', lat=48.528, long=135.188333), mar2=None), flight(), flight()]
+        client.put('/flights', json=data, headers=random_superuser_headers)
+        params = dict(date_start=dt_string(days=-5), date_end=dt_string(days=1), limit=2, **paging)
+
+        orm_page = client.get('/flights', params=params)
+        orm_by_ids = client.post('/flights', json=[3, 100, 1])
+        monkeypatch.setattr(settings, 'FLIGHT_RENDERING', 'database')
+        db_page = client.get('/flights', params=params)
+        db_by_ids = client.post('/flights', json=[3, 100, 1])
+
+        assert db_page.status_code == 200
+        assert json.loads(db_page.content) == json.loads(orm_page.content)
+        assert json.loads(db_by_ids.content) == json.loads(orm_by_ids.content)
+
+    @pytest.mark.parametrize('order_type', ('asc', 'desc'))
+    async def test_get_many_keyset(self, order_type, client, random_superuser_headers):
+        data = [flight(sked_local=dt_string(days=-2, minutes=n // 2)) for n in range(25)]
+        client.put('/flights', json=data, headers=random_superuser_headers)
+        params = dict(date_start=dt_string(days=-5), date_end=dt_string(days=1), limit=10, order_type=order_type)
+
+        pages, cursor = [], ''
+        while cursor is not None:
+            content = client.get('/flights', params=dict(params, cursor=cursor)).json()
+            pages.append(content)
+            cursor = content['next']
+
+        orig_ids = [item['orig_id'] for page in pages for item in page['items']]
+        assert [page['count'] for page in pages] == [10, 10, 5]
+        assert pages[0]['prev'] is None
+        assert sorted(orig_ids) == sorted(d['orig_id'] for d in data)
+
+        keys = [(item['sked_local'], item['id']) for page in pages for item in page['items']]
+        assert keys == sorted(keys, reverse=order_type == 'desc')
+
+        prev_content = client.get('/flights', params=dict(params, cursor=pages[-1]['prev'])).json()
+        assert [item['id'] for item in prev_content['items']] == [item['id'] for item in pages[-2]['items']]
+
+    async def test_export(self, client, random_superuser_headers):
+        data = [flight(sked_local=dt_string(days=-days)) for days in (20, 10, 1)]
+        client.put('/flights', json=data, headers=random_superuser_headers)
+        params = dict(date_start=dt_string(days=-30), date_end=dt_string(days=1))
+
+        ndjson_response = client.get('/flights/export', params=params)
+        csv_response = client.get('/flights/export', params=dict(params, format='csv'))
+
+        assert ndjson_response.status_code == 200
+        items = [json.loads(line) for line in ndjson_response.text.splitlines()]
+        assert [item['orig_id'] for item in items] == [d['orig_id'] for d in data]
+        assert compare(data[0], items[0])
+
+        assert csv_response.status_code == 200
+        header, *rows = csv_response.text.splitlines()
+        assert 'orig_id' in header.split(',')
+        assert len(rows) == 3
+
+    async def test_export_not_cached(self, client, random_superuser_headers):
+        data = [flight(sked_local=dt_string(days=-days)) for days in (20, 1)]
+        client.put('/flights', json=data, headers=random_superuser_headers)
+
+        wide = client.get('/flights/export', params=dict(date_start=dt_string(days=-30), date_end=dt_string(days=1)))
+        narrow = client.get('/flights/export', params=dict(date_start=dt_string(days=-5), date_end=dt_string(days=1), format='csv'))
+
+        assert 'x-cache' not in wide.headers and 'x-cache' not in narrow.headers
+        assert len(wide.text.splitlines()) == 2
+        assert len(narrow.text.splitlines()) == 2     # header and one row
+
+    async def test_delays(self, client, random_superuser_headers):
+        su, s7 = company(iata='SU'), company(iata='S7')
+        data = [
+            *(flight(company=su, sked_local=dt_string(days=-2), at_local=dt_string(days=-2, minutes=delay)) for delay in (0, 10, 30)),
+            flight(company=s7, sked_local=dt_string(days=-2), at_local=dt_string(days=-2, minutes=60)),
+            flight(company=s7, sked_local=dt_string(days=-2), at_local=None),
+        ]
+        client.put('/flights', json=data, headers=random_superuser_headers)
+        params = dict(date_start=dt_string(days=-30), date_end=dt_string(days=1))
+
+        response = client.get('/flights/delays', params=params)
+        by_day = client.get('/flights/delays', params=dict(params, company='SU', group_by='day', timezone='Europe/Moscow'))
+        unknown_timezone = client.get('/flights/delays', params=dict(params, timezone='Nowhere/Nowhere'))
+
+        svo, khv, u6 = airport(iata='SVO'), airport(iata='KHV'), company(iata='U6')
+        routes = [
+            flight(company=u6, direction='departure', mar1=svo, mar2=khv, sked_local=dt_string(days=-2), at_local=dt_string(days=-2)),
+            flight(company=u6, direction='arrival', mar1=khv, mar2=svo, sked_local=dt_string(days=-2), at_local=dt_string(days=-2)),
+        ]
+        client.put('/flights', json=routes, headers=random_superuser_headers)
+        by_destination = client.get('/flights/delays', params=dict(params, company='U6', group_by='destination'))
+
+        assert response.status_code == 200
+        s7_stats, su_stats = response.json()
+        assert (s7_stats['key'], s7_stats['count'], s7_stats['p50'], s7_stats['on_time_share']) == ('S7', 1, 60, 0)
+        assert (su_stats['key'], su_stats['count'], su_stats['mean'], su_stats['p50']) == ('SU', 3, 13.3, 10)
+        assert su_stats['on_time_share'] == pytest.approx(2 / 3, abs=1e-4)
+        assert [item['count'] for item in by_day.json()] == [3]
+        assert [(item['key'], item['count']) for item in by_destination.json()] == [('KHV', 2)]
+        assert unknown_timezone.status_code == 400
+
+    @pytest.mark.parametrize('cursor', (
+            'not a cursor',
+            utils.encode_cursor('next', [dt_string(days=-2), 'one']),
+            utils.encode_cursor('next', [1, 1]),
+    ))
+    async def test_get_many_keyset_invalid_cursor(self, cursor, client):
+        params = dict(date_start=dt_string(days=-5), date_end=dt_string(days=1), cursor=cursor)
+        response = client.get('/flights', params=params)
+
+        assert response.status_code == 400
+
+
+@pytest.mark.usefixtures('recreate_tables',)
+class TestSearch:
+    async def test_search(self, client, random_superuser_headers):
+        data = [
+            airport(iata='SVO', name='Sheremetyevo', city=city(name='Moscow')),
+            airport(iata='LED', name='Pulkovo', city=city(name='Saint Petersburg')),
+        ]
+        client.put('/airports', json=data, headers=random_superuser_headers)
+        client.put('/companies', json=[company(iata='SU', name='Aeroflot')], headers=random_superuser_headers)
+
+        response = client.get('/search', params=dict(q='sheremet'))
+        by_code = client.get('/search', params=dict(q='svo', kind='airport'))
+        city_response = client.get('/search', params=dict(q='mosc', kind='city,company'))
+
+        assert response.status_code == 200
+        assert response.json()[0]['code'] == 'SVO'
+        assert [item['code'] for item in by_code.json()] == ['SVO']
+        assert [(item['kind'], item['name']) for item in city_response.json()] == [('city', 'Moscow')]
+
+    async def test_search_unnamed(self, client, random_superuser_headers):
+        client.put('/companies', json=[company(iata='SU', name=None)], headers=random_superuser_headers)
+
+        response = client.get('/search', params=dict(q='SU'))
+
+        assert response.status_code == 200
+        assert [(item['code'], item['name']) for item in response.json()] == [('SU', None)]
+
+    async def test_search_invalid(self, client):
+        assert client.get('/search', params=dict(q='s')).status_code == 422
+        assert client.get('/search', params=dict(q=' s ')).status_code == 422
+        assert client.get('/search', params=dict(q='svo', kind='flight')).status_code == 422
+
 
 @pytest.mark.parametrize(
     'endpoint',
@@ -534,6 +989,45 @@ class TestCommonPositive:
         assert compare(data[0], content['items'][0])        # default order is by name or orig_id
         assert compare(data[1], content['items'][1])
 
+    @pytest.mark.parametrize(
+        'count, total, total_pages',
+        (
+                ('exact', 3, 2),
+                ('none', None, None),
+        )
+    )
+    async def test_get_many_count(self, count, total, total_pages, client, random_superuser_headers):
+        client.put('/companies', json=[company(), company(), company()], headers=random_superuser_headers)
+
+        response = client.get('/companies', params=dict(count=count, limit=2, page=1))
+        content = response.json()
+
+        assert response.status_code == 200
+        assert content['count'] == 1
+        assert content['total'] == total
+        assert content['total_pages'] == total_pages
+
+    async def test_get_many_count_none_not_modified(self, client, random_superuser_headers):
+        client.put('/companies', json=[company(iata='SU', name='Aeroflot')], headers=random_superuser_headers)
+        params = dict(count='none')
+
+        response = client.get('/companies', params=params)
+        not_modified = client.get('/companies', params=params, headers={'If-None-Match': response.headers['etag']})
+        client.put('/companies', json=[company(iata='SU', name='Renamed')], headers=random_superuser_headers)
+        modified = client.get('/companies', params=params, headers={'If-None-Match': response.headers['etag']})
+
+        assert (response.status_code, not_modified.status_code, modified.status_code) == (200, 304, 200)
+
+    async def test_get_many_count_estimate(self, client, random_superuser_headers):
+        client.put('/companies', json=[company(), company()], headers=random_superuser_headers)
+
+        response = client.get('/companies', params=dict(count='estimate'))
+        content = response.json()
+
+        assert response.status_code == 200
+        assert isinstance(content['total'], int)
+        assert isinstance(content['total_pages'], int)
+
     @pytest.mark.parametrize(
         'endpoint, data_cb, order_by, params',
         (
@@ -0,0 +1,28 @@
+import os
+
+from app.response_cache import FileBackend
+
+
+def test_file_backend_removes_expired(tmp_path):
+    backend = FileBackend(str(tmp_path))
+    backend.set('flights:0:/flights/?', 'expired', ttl=-1)
+    backend.set('flights:0:/flights/1?', 'fresh', ttl=60)
+
+    assert backend.get('flights:0:/flights/?') is None
+    assert backend.get('flights:0:/flights/1?') == 'fresh'
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_file_backend_prunes_replaced_generations(tmp_path):
+    backend = FileBackend(str(tmp_path))
+    backend.set('flights:0:/flights/?', 'old', ttl=60)
+    backend.set('companies:0:/companies/?', 'kept', ttl=60)
+    backend.set('airports:0:/airports/?', 'expired', ttl=-1)
+    backend.bump('flights')
+    key = f'flights:{backend.generation("flights")}:/flights/?'
+    backend.set(key, 'new', ttl=60)
+
+    backend.prune()
+
+    assert (backend.get(key), backend.get('companies:0:/companies/?')) == ('new', 'kept')
+    assert len(os.listdir(tmp_path)) == 3    # the entries and the generation file